@@ -0,0 +1,69 @@
+from pyo64 import *
+import numpy as np
+
+
+# Number of points per second of performance in the control tables
+CONTROL_RATE = 100
+
+
+def forward_fill(values):
+    """
+    Forward filling function: replaces the zeros of an array by the last non-zero value before them (the first non-zero
+    value for the leading zeros)
+
+    :param values: Array of values
+    :return: Filled array, unchanged if it has no non-zero value
+    """
+    values = np.asarray(values, dtype=np.float64)
+    nonzero = np.flatnonzero(values)
+    if len(nonzero) == 0:
+        return values
+    last = np.maximum.accumulate(np.where(values != 0, np.arange(len(values)), nonzero[0]))
+    return values[last]
+
+
+class Control_Timeline:
+
+    def __init__(self, durations, tail=0.):
+        """
+        Control timeline initialization function: one phasor runs through the whole performance, and every control
+        table is read at its phase, so that the values change at the start of each time-step in the audio engine
+
+        :param durations: List of the durations, in seconds, of the time-steps
+        :param tail: Time, in seconds, after the last time-step during which its values are held
+        :return: an initialized control timeline
+        """
+        # Rounded on the cumulated times, so that the rounding errors do not add up over the time-steps
+        ends = np.round(np.cumsum(np.asarray(durations, dtype=np.float64))*CONTROL_RATE).astype(int)
+        self.counts = np.diff(np.concatenate(([0], ends)))
+        self.size = max(int(ends[-1])+int(round(tail*CONTROL_RATE)), 1)
+        self.phasor = Phasor(freq=CONTROL_RATE/self.size)
+
+
+    def track(self, values, hold=1):
+        """
+        Control track function
+
+        :param values: Array containing one value per time-step
+        :param hold: Number of time-steps each value is held for, the values in between are ignored
+        :return pointer: Pyo object reading the values on the timeline
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if hold > 1:
+            values = values[(np.arange(len(values))//hold)*hold]
+        points = np.repeat(values, self.counts)
+        # The last value is held until the end of the table
+        points = np.concatenate((points, np.full(self.size-len(points), values[-1])))
+        table = DataTable(self.size, init=points.tolist())
+        return Pointer(table, self.phasor)
+
+
+    def reset(self):
+        """
+        Timeline reset function, called at the start of the first time-step
+
+        :param:
+        :return:
+        """
+        self.phasor.reset()
+        return
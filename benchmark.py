@@ -0,0 +1,155 @@
+import click
+import time
+import os
+import gc
+import resource
+import tempfile
+import contextlib
+import numpy as np
+from image_processing import *
+from sound_module import *
+
+
+@click.group()
+def benchmark():
+    pass
+
+
+@benchmark.command("entropy")
+@click.argument("image_path", type=str, default='Images/preview.jpg')
+@click.option("--radius", type=int, default=FOOTPRINT_RADIUS)
+@click.option("--bins", type=int, default=[16, 32, 64], multiple=True)
+
+
+def benchmark_entropy(
+    image_path,
+    radius,
+    bins
+):
+    """
+    Compares the sliding histogram entropy kernel with skimage's rank entropy
+    """
+    image = pre_process(image_path)
+    print('Image shape :', image.shape)
+    start = time.time()
+    reference = entropy(image, disk(radius))
+    time_reference = time.time()-start
+    print('skimage rank entropy : {:.2f}s'.format(time_reference))
+    start = time.time()
+    information = local_entropy(image, radius, 256)
+    time_kernel = time.time()-start
+    print('local_entropy, 256 bins : {:.2f}s (x{:.2f})'.format(time_kernel, time_reference/time_kernel))
+    print('Same output :', np.allclose(reference, information), '(max difference {:.2e})'.format(np.max(np.abs(reference-information))))
+    for nb_bins in bins:
+        start = time.time()
+        local_entropy(image, radius, nb_bins)
+        time_kernel = time.time()-start
+        print('local_entropy, {} bins : {:.2f}s (x{:.2f})'.format(nb_bins, time_kernel, time_reference/time_kernel))
+
+
+
+def count_pyo_objects():
+    """
+    Counts the pyo objects alive in the interpreter
+
+    :param:
+    :return: Number of pyo objects
+    """
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, PyoObjectBase))
+
+
+@benchmark.command("soak")
+@click.option("--samples-dir-1", type=str, default='Samples/Melodic/')
+@click.option("--samples-dir-2", type=str, default='Samples/Voices/')
+@click.option("--samples-dir-3", type=str, default='Samples/Aggressive/')
+@click.option("--samples-dir-4", type=str, default='Samples/Beat/')
+@click.option("--nb-grn", type=int, default=3)
+@click.option("--nb-clouds", type=int, default=2)
+@click.option("--steps", type=int, default=10000)
+@click.option("--step-time", type=float, default=0.05)
+@click.option("--measures", type=int, default=10)
+
+
+def benchmark_soak(
+    samples_dir_1,
+    samples_dir_2,
+    samples_dir_3,
+    samples_dir_4,
+    nb_grn,
+    nb_clouds,
+    steps,
+    step_time,
+    measures
+):
+    """
+    Renders a long performance on an offline server, reporting pyo objects (besides the decoded samples kept by the
+    sample tables cache) and memory along the way
+    """
+    list_blocks = list(np.random.RandomState(0).rand(steps))
+    path = os.path.join(tempfile.mkdtemp(), 'soak.wav')
+    sound = Sound_Module([nb_grn, nb_clouds], samples_dir_1, samples_dir_2, samples_dir_3, samples_dir_4, list_blocks, 60, 8,
+                         normalized=True, path_record=path, offline=True, seed=0)
+    # Short time-steps, so that many of them fit in a reasonable rendering time
+    sound.wait_times = [step_time]*steps
+    results = []
+    def measure():
+        results.append((len(results)*steps//measures, sound.s.getNumberOfStreams(), count_pyo_objects()-len(sound.tables.tables),
+                        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    measure()
+    pattern = Pattern(measure, time=steps*step_time/measures).play(delay=steps*step_time/measures)
+    start = time.time()
+    # The time-steps print their content, which is not needed here
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        sound.render()
+    print('Rendered {} time-steps ({:.0f}s of audio) in {:.2f}s'.format(steps, steps*step_time, time.time()-start))
+    print('{:>8} {:>10} {:>12} {:>14}'.format('step', 'streams', 'pyo objects', 'max RSS (kB)'))
+    for step, streams, objects, rss in results[:measures+1]:
+        print('{:>8} {:>10} {:>12} {:>14}'.format(step, streams, objects, rss))
+    print('Sample tables cache :', sound.tables.stats())
+    os.remove(path)
+
+
+
+@benchmark.command("objects")
+@click.option("--samples-dir-1", type=str, default='Samples/Melodic/')
+@click.option("--samples-dir-2", type=str, default='Samples/Voices/')
+@click.option("--samples-dir-3", type=str, default='Samples/Aggressive/')
+@click.option("--samples-dir-4", type=str, default='Samples/Beat/')
+@click.option("--nb-grn", type=int, default=3)
+@click.option("--nb-clouds", type=int, default=2)
+@click.option("--steps", type=int, default=3000)
+
+
+def benchmark_objects(
+    samples_dir_1,
+    samples_dir_2,
+    samples_dir_3,
+    samples_dir_4,
+    nb_grn,
+    nb_clouds,
+    steps
+):
+    """
+    Plays many time-steps without computing any audio, failing if the number of pyo objects (besides the decoded
+    samples kept by the sample tables cache, bounded by its memory budget) changes
+    """
+    list_blocks = list(np.random.RandomState(0).rand(steps))
+    # The offline server is booted but never started: the control code runs, the pyo graphs are not computed
+    sound = Sound_Module([nb_grn, nb_clouds], samples_dir_1, samples_dir_2, samples_dir_3, samples_dir_4, list_blocks, 60, 8,
+                         normalized=True, offline=True, seed=0)
+    gc.collect()
+    before = count_pyo_objects()-len(sound.tables.tables)
+    start = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for i in range(steps):
+            sound.play_step(i)
+    gc.collect()
+    after = count_pyo_objects()-len(sound.tables.tables)
+    print('Played {} time-steps in {:.2f}s, pyo objects : {} before, {} after'.format(steps, time.time()-start, before, after))
+    print('Sample tables cache :', sound.tables.stats())
+    if after != before:
+        raise click.ClickException('The number of pyo objects changed from {} to {}'.format(before, after))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,191 @@
+from sound_module import *
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import contextlib
+import tempfile
+import shutil
+import sys
+
+
+# Instrument groups rendered by separate processes (see INSTRUMENT_GROUPS)
+GROUPS = ['granular', 'cloud', 'bass']
+# Duration, in seconds, of the shared memory ring buffers between the workers and the master server, the latency of the
+# parallel performance
+RING_DURATION = 0.5
+
+
+def render_group(group, path, args, kwargs, score_path=None, verbose=0, quiet=True):
+    """
+    Worker function: renders the instruments of one group to a file. Every worker builds the same sound module
+    from the same seed, so that the conductors are identical and only the group heard differs
+
+    :param group: Name of the instrument group to render
+    :param path: Path of the .wav file to write
+    :param args: Positional arguments of the sound module
+    :param kwargs: Keyword arguments of the sound module, the seed must be given
+    :param score_path: Optional path of the .npz score to write, from this worker's sound module
+    :param verbose: Verbosity of the printed time-steps
+    :param quiet: Boolean to hide the time-steps printed by the worker
+    :return duration: Duration, in seconds, of the rendered file
+    """
+    output = open(os.devnull, 'w') if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        sound = Sound_Module(*args, path_record=path, offline=True, groups={group}, **kwargs)
+        if score_path:
+            save_score(score_path, sound)
+        sound.render(verbose)
+    return sound.duration()
+
+
+def mix_files(paths, path, duration):
+    """
+    Mixing function: sums the rendered groups into the final file, offline
+
+    :param paths: List of the paths of the .wav files to mix
+    :param path: Path of the .wav file to write
+    :param duration: Duration, in seconds, of the mix
+    :return:
+    """
+    s = Server(audio='offline', nchnls=2)
+    s.boot()
+    s.recordOptions(dur=duration, filename=path, fileformat=0, sampletype=1)
+    players = [SfPlayer(file) for file in paths]
+    mix = Mix(players, voices=2).out()
+    s.start()
+    s.shutdown()
+    return
+
+
+def render_parallel(args, kwargs, path, groups=GROUPS, score_path=None, verbose=0):
+    """
+    Parallel rendering function: each group of instruments is rendered by its own process, then the groups are mixed
+
+    :param args: Positional arguments of the sound module
+    :param kwargs: Keyword arguments of the sound module, the seed must be given
+    :param path: Path of the .wav file to write
+    :param groups: List of the instrument groups to render
+    :param score_path: Optional path of the .npz score to write
+    :param verbose: Verbosity of the printed time-steps
+    :return:
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        paths = [os.path.join(directory, group+'.wav') for group in groups]
+        # Fresh processes, so that each worker boots its own server. The conductors of every worker are the same, the
+        # time-steps are printed by the first one only
+        with ProcessPoolExecutor(max_workers=len(groups), mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(render_group, group, file, args, kwargs, score_path if j == 0 else None, verbose, j > 0)
+                       for j, (group, file) in enumerate(zip(groups, paths))]
+            durations = [future.result() for future in futures]
+        print('Mixing', len(groups), 'groups ...')
+        mix_files(paths, path, max(durations))
+    finally:
+        shutil.rmtree(directory)
+    return
+
+
+def play_group(group, names, size, written, clock, ready, args, kwargs, score_path=None, verbose=0, quiet=True):
+    """
+    Worker function: plays the instruments of one group on an embedded server and writes its stereo output to shared
+    memory ring buffers, one buffer at a time, never overwriting what the master server has not read yet
+
+    :param group: Name of the instrument group to play
+    :param names: Names of the shared tables of the left and right channels
+    :param size: Size, in samples, of the shared tables
+    :param written: Shared counter of the samples written by the worker
+    :param clock: Shared counter of the samples read by the master server
+    :param ready: Event set once the ring buffers are filled
+    :param args: Positional arguments of the sound module
+    :param kwargs: Keyword arguments of the sound module, the seed must be given
+    :param score_path: Optional path of the .npz score to write, from this worker's sound module
+    :param verbose: Verbosity of the printed time-steps
+    :param quiet: Boolean to hide the time-steps printed by the worker
+    :return:
+    """
+    output = open(os.devnull, 'w') if quiet else sys.stdout
+    with contextlib.redirect_stdout(output):
+        sound = Sound_Module(*args, embedded=True, groups={group}, **kwargs)
+        if score_path:
+            save_score(score_path, sound)
+        buffer_size = sound.s.getBufferSize()
+        mix = Mix(sound.outputs(), voices=2)
+        fills = [TableFill(mix[j], SharedTable(name, create=False, size=size)) for j, name in enumerate(names)]
+        buffers = int(np.ceil(sound.duration()*sound.s.getSamplingRate()/buffer_size))
+        sound.s.start()
+        sound.start_all()
+        # The time-steps are played on the clock of the embedded server, which follows the master server
+        sound.schedule_steps(verbose)
+        # After the performance, a whole ring of silence is written so that the master server never reads old buffers
+        for k in range(buffers+size//buffer_size):
+            if k == buffers:
+                mix.mul = 0
+            # Waits for the master server to read the buffer about to be overwritten
+            while written.value-clock.value > size-2*buffer_size:
+                if not ready.is_set():
+                    ready.set()
+                time.sleep(buffer_size/sound.s.getSamplingRate()/4)
+            sound.s.process()
+            written.value += buffer_size
+        ready.set()
+        sound.s.stop()
+    return
+
+
+def play_parallel(args, kwargs, groups=GROUPS, score_path=None, verbose=0, record_path=None, server=None):
+    """
+    Parallel performance function: each group of instruments is played by its own process, the master server reads
+    their outputs from shared memory ring buffers and mixes them to the speakers
+
+    :param args: Positional arguments of the sound module
+    :param kwargs: Keyword arguments of the sound module, the seed must be given
+    :param groups: List of the instrument groups to play
+    :param score_path: Optional path of the .npz score to write
+    :param verbose: Verbosity of the printed time-steps
+    :param record_path: Optional path of the .wav file recording the mix
+    :param server: Booted master server, a real-time server is booted if None
+    :return underruns: Number of buffers the master server read before a worker had written them
+    """
+    s = server if server is not None else Server().boot()
+    buffer_size = s.getBufferSize()
+    size = int(RING_DURATION*s.getSamplingRate())//buffer_size*buffer_size
+    context = multiprocessing.get_context('spawn')
+    clock = context.Value('q', 0)
+    names = {group: ['/hearwydns-{}-{}-{}'.format(os.getpid(), group, j) for j in range(2)] for group in groups}
+    # The master server creates the shared tables, the workers open them
+    tables = [SharedTable(name, create=True, size=size) for group in groups for name in names[group]]
+    written = {group: context.Value('q', 0) for group in groups}
+    ready = {group: context.Event() for group in groups}
+    workers = [context.Process(target=play_group, args=(group, names[group], size, written[group], clock, ready[group], args, kwargs,
+                                                        score_path if j == 0 else None, verbose, j > 0))
+               for j, group in enumerate(groups)]
+    for worker in workers:
+        worker.start()
+    for group, worker in zip(groups, workers):
+        while not ready[group].wait(0.5):
+            if not worker.is_alive():
+                raise RuntimeError('The worker playing the {} group stopped'.format(group))
+    # Reads the rings from their start, in the order of the channels
+    mix = Mix([TableScan(table) for table in tables], voices=2).out()
+    underruns = [0]
+    def tick():
+        clock.value += buffer_size
+        # A worker behind the master server makes it read an old buffer
+        if any(counter.value < clock.value for counter in written.values()):
+            underruns[0] += 1
+    s.setCallback(tick)
+    if record_path:
+        s.recordOptions(filename=record_path, fileformat=0, sampletype=1)
+    s.start()
+    if record_path:
+        s.recstart()
+    for worker in workers:
+        worker.join()
+    # Waits for the master server to read the end of the performance, before the ring of silence
+    end = min(counter.value for counter in written.values())-size
+    while clock.value < end:
+        time.sleep(0.1)
+    if record_path:
+        s.recstop()
+    s.stop()
+    print('Underruns :', underruns[0])
+    return underruns[0]
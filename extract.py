@@ -0,0 +1,77 @@
+import click
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from image_processing import *
+from feature_cache import *
+
+
+def list_images(images_dir):
+    """
+    Image listing function
+
+    :param images_dir: Directory to walk
+    :return: Sorted list of image paths found in the directory and its sub-directories
+    """
+    list_paths = []
+    for root, dirs, files in os.walk(images_dir):
+        for file in files:
+            if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
+                list_paths.append(os.path.join(root, file))
+    return sorted(list_paths)
+
+
+def analyse_image(image_path, list_mask_sizes):
+    """
+    Single image analysis function
+
+    :param image_path: Path of the image to analyse
+    :param list_mask_sizes: List of mask sizes
+    :return: The image path, the image shape and a dictionary of entropy vectors by mask size
+    """
+    image = pre_process(image_path)
+    return image_path, image.shape[:2], entropy_pyramid(image, list_mask_sizes)
+
+
+@click.command()
+@click.argument("images_dir", type=str)
+@click.argument("output", type=str, default='features.npz')
+@click.option("--mask-size", type=int, default=[100], multiple=True)
+@click.option("--workers", type=int, default=os.cpu_count())
+
+
+def extract(
+    images_dir,
+    output,
+    mask_size,
+    workers
+):
+    list_paths = list_images(images_dir)
+    print('Found', len(list_paths), 'images in', images_dir)
+    results = {}
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(analyse_image, path, mask_size): path for path in list_paths}
+        for count, future in enumerate(as_completed(futures), 1):
+            try:
+                image_path, shape, pyramid = future.result()
+                results[image_path] = (shape, pyramid)
+            except Exception as error:
+                print()
+                print('Skipping', futures[future], ':', error)
+            # Prints progress and throughput
+            elapsed = time.time()-start
+            print('{}/{} images, {:.2f} images/s'.format(count, len(list_paths), count/elapsed), end='\r')
+    print()
+    # Writes one row per image and mask size, in path order
+    rows = [(path, size) for path in list_paths if path in results for size in mask_size]
+    save_feature_store(output,
+                       [path for path, size in rows],
+                       [results[path][0] for path, size in rows],
+                       [size for path, size in rows],
+                       [results[path][1][size] for path, size in rows])
+    print('Features of', len(results), 'images written to', output, 'in {:.1f}s'.format(time.time()-start))
+
+
+if __name__ == "__main__":
+    extract()
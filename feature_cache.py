@@ -0,0 +1,174 @@
+import numpy as np
+import hashlib
+import os
+
+
+class Feature_Cache:
+
+    def __init__(self, cache_dir, max_bytes=256*1024*1024):
+        """
+        Feature cache initialization function
+
+        :param cache_dir: Directory in which the entropy vectors and local entropy maps are stored
+        :param max_bytes: Maximum size of the cache on disk, least recently used entries are evicted beyond it
+        :return: an initialized feature cache
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Digest of each image already hashed
+        self.hashes = {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def hash_image(self, image_path):
+        """
+        Image hashing function
+
+        :param image_path: Path of the image to hash
+        :return: Hexadecimal digest of the image content
+        """
+        if image_path not in self.hashes:
+            digest = hashlib.sha256()
+            with open(image_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.hashes[image_path] = digest.hexdigest()
+        return self.hashes[image_path]
+
+
+    def key(self, image_path, mask_size, radius, normalized, bins=256):
+        """
+        Cache key building function
+
+        :param image_path: Path of the analysed image
+        :param mask_size: Size of the mask
+        :param radius: Radius of the entropy footprint
+        :param normalized: Boolean indicating whether the entropy is normalized or not
+        :param bins: Number of grey levels used for the entropy
+        :return: Key identifying the features of the image
+        """
+        return '{}-{}-{}-{}-{}'.format(self.hash_image(image_path), mask_size, radius, int(normalized), bins)
+
+
+    def map_key(self, image_path, radius, bins=256):
+        """
+        Local entropy map key building function, the map serves every mask size
+
+        :param image_path: Path of the analysed image
+        :param radius: Radius of the entropy footprint
+        :param bins: Number of grey levels used for the entropy
+        :return: Key identifying the local entropy map of the image
+        """
+        return '{}-map-{}-{}'.format(self.hash_image(image_path), radius, bins)
+
+
+    def path(self, key):
+        """
+        Cache entry path function
+
+        :param key: Key of the entry
+        :return: Path of the file storing the entry
+        """
+        return os.path.join(self.cache_dir, key+'.npy')
+
+
+    def load(self, key):
+        """
+        Cache reading function
+
+        :param key: Key of the entry
+        :return: The cached entropy vector (or local entropy map), or None if absent
+        """
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        # Marks the entry as recently used
+        os.utime(path)
+        return np.load(path)
+
+
+    def save(self, key, list_blocks):
+        """
+        Cache writing function
+
+        :param key: Key of the entry
+        :param list_blocks: Entropy vector (or local entropy map) to store
+        :return: Boolean indicating whether the entry was stored, an entry larger than the cache budget is not
+        """
+        list_blocks = np.asarray(list_blocks)
+        if list_blocks.nbytes > self.max_bytes:
+            return False
+        path = self.path(key)
+        # Writes to a temporary file first so that readers never see a partial entry
+        tmp = path+'.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, list_blocks)
+        os.replace(tmp, path)
+        self.evict(keep=key)
+        return True
+
+
+    def evict(self, keep=None):
+        """
+        Least recently used eviction function
+
+        :param keep: Key of an entry never evicted, the one just written
+        :return:
+        """
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.npy') and file != (keep+'.npy' if keep else None):
+                stat = os.stat(os.path.join(self.cache_dir, file))
+                entries.append((stat.st_mtime, stat.st_size, file))
+        total = sum(entry[1] for entry in entries)
+        kept = os.path.getsize(self.path(keep)) if keep and os.path.exists(self.path(keep)) else 0
+        # Removes the oldest entries until the cache fits in its budget
+        for mtime, size, file in sorted(entries):
+            if total+kept <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, file))
+            total -= size
+        return
+
+
+def save_feature_store(path, list_paths, list_shapes, list_mask_sizes, list_features):
+    """
+    Columnar feature store writing function
+
+    :param path: Path of the .npz file to write
+    :param list_paths: Path of each analysed image
+    :param list_shapes: Shape (rows, columns) of each analysed image
+    :param list_mask_sizes: Mask size used for each image
+    :param list_features: Entropy vector of each image
+    :return:
+    """
+    # Entropy vectors have different lengths: they are concatenated and indexed by offsets
+    lengths = [len(features) for features in list_features]
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    if len(list_features) > 0:
+        values = np.concatenate([np.asarray(features, dtype=np.float64) for features in list_features])
+    else:
+        values = np.array([], dtype=np.float64)
+    np.savez_compressed(path,
+                        path=np.array(list_paths, dtype=str),
+                        shape=np.array(list_shapes, dtype=np.int64).reshape(-1, 2),
+                        mask_size=np.array(list_mask_sizes, dtype=np.int64),
+                        offsets=offsets,
+                        entropy=values)
+    return
+
+
+def load_feature_store(path):
+    """
+    Columnar feature store reading function
+
+    :param path: Path of the .npz file to read
+    :return: Dictionary mapping each (image path, mask size) to the image shape and its entropy vector
+    """
+    store = np.load(path)
+    offsets = store['offsets']
+    features = {}
+    for i, image_path in enumerate(store['path']):
+        features[(str(image_path), int(store['mask_size'][i]))] = {'shape': tuple(int(x) for x in store['shape'][i]),
+                                                                    'entropy': store['entropy'][offsets[i]:offsets[i+1]]}
+    return features
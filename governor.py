@@ -0,0 +1,64 @@
+# Fraction of the budget under which voices left out by the governor are played again, so that they do not flap
+RESTORE_MARGIN = 0.8
+
+
+class Voice_Governor:
+
+    def __init__(self, budget, costs=None):
+        """
+        Voice governor initialization function
+
+        :param budget: Highest load allowed, in CPU time per second of audio (1 is the real-time limit)
+        :param costs: Optional dictionary mapping instrument names to their load (see metrics.Server_Metrics.calibrate),
+                      the measured load is shared evenly between the instruments playing otherwise
+        :return: an initialized voice governor
+        """
+        self.budget = budget
+        self.costs = {} if costs is None else costs
+        # Instruments planned by the conductor but left out
+        self.stolen = set()
+
+
+    def cost(self, instrument, load, nb_playing):
+        """
+        Instrument cost function
+
+        :param instrument: Name of the instrument
+        :param load: Last measured load of the server
+        :param nb_playing: Number of instruments playing during that measure
+        :return: Estimated load of the instrument
+        """
+        if instrument in self.costs:
+            return self.costs[instrument]
+        return load/max(nb_playing, 1)
+
+
+    def allowed(self, planned, i, sound):
+        """
+        Voice stealing function: leaves out the quietest planned instruments until the estimated load fits the budget
+
+        :param planned: Set of instruments the conductor plans to play
+        :param i: current time-step
+        :param sound: Sound module playing the time-step
+        :return keep: Set of instruments allowed to play
+        """
+        if sound.metrics is None or sound.metrics.last is None:
+            return set(planned)
+        load = sound.metrics.last['load']
+        nb_playing = len(sound.active)
+        # Estimated load if the plan were followed
+        estimate = load
+        estimate += sum(self.cost(name, load, nb_playing) for name in planned - sound.active)
+        estimate -= sum(self.cost(name, load, nb_playing) for name in sound.active - planned)
+        # Instruments already left out come first, then the quietest and, among them, the most expensive
+        order = sorted(planned, key=lambda name: (name not in self.stolen, sound.conductor[name][i], -self.cost(name, load, nb_playing)))
+        keep = set(planned)
+        for name in order:
+            limit = RESTORE_MARGIN*self.budget if name in self.stolen else self.budget
+            # Keeps at least one instrument playing
+            if estimate <= limit or len(keep) <= 1:
+                break
+            keep.remove(name)
+            estimate -= self.cost(name, load, nb_playing)
+        self.stolen = planned - keep
+        return keep
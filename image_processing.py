@@ -3,10 +3,29 @@ from skimage.filters.rank import entropy
 from skimage import data
 from skimage.util import img_as_ubyte
 from skimage.morphology import disk
-from skimage.color import rgb2gray
+from skimage.filters import sobel
 import matplotlib.pyplot as plt
 from skimage import io
 from matplotlib.pyplot import plot, ion, show
+from concurrent.futures import ProcessPoolExecutor
+import os
+import tifffile
+
+
+# Radius of the disk footprint used for local entropy
+FOOTPRINT_RADIUS = 10
+
+# Luminance weights of rgb2gray (R, G, B), scaled by 10000
+LUMINANCE_WEIGHTS = np.array([2125, 7154, 721], dtype=np.uint32)
+
+# Per-block features returned by extract_features
+FEATURES_DTYPE = np.dtype([('entropy', np.float64),
+                           ('edges', np.float64),
+                           ('variance', np.float64, (3,)),
+                           ('spectral', np.float64)])
+
+# Image extensions considered when reading a directory
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.npy']
 
 
 def moving_mask(image, mask_size):
@@ -36,22 +55,519 @@ def extract_from_mask(list_regions):
     """
     information = []
     for i in list_regions:
-        information.append(np.mean(entropy(i, disk(10))))
-    information = np.array(information)
-    for i in range(len(information)):
-        information[i] = (information[i]-np.min(information))/(np.max(information))
-    return information
-    
+        information.append(np.mean(entropy(i, disk(FOOTPRINT_RADIUS))))
+    return normalize_blocks(np.array(information))
+
+
+def local_entropy(image, radius=FOOTPRINT_RADIUS, bins=256, width=4096):
+    """
+    Sliding histogram local entropy function, giving the same output as
+    skimage's rank entropy with a disk footprint when bins is 256
+
+    :param image: input 8 bits grayscale image
+    :param radius: radius of the disk footprint
+    :param bins: number of grey levels the image is quantized to (e.g. 16, 32, 64 or 256)
+    :param width: number of pixels updated at once, the image rows being processed by stripes in lockstep
+    :return: local entropy map (in bits) of the image
+    """
+    image = np.asarray(image, dtype=np.uint8)
+    num_rows, num_columns = image.shape
+    nb_levels = bins+1
+    # Splits the image into stripes that slide down at the same time
+    nb_stripes = max(1, min(num_rows, width//num_columns))
+    stripe_rows = -(-num_rows//nb_stripes)
+    # Pixels outside the image go to an extra level, ignored by the entropy
+    padded_columns = num_columns+2*radius
+    padded = np.full((nb_stripes*stripe_rows+2*radius+1, padded_columns), bins, dtype=np.uint16)
+    padded[radius:radius+num_rows, radius:radius+num_columns] = (image.astype(np.uint16)*bins) >> 8
+    padded = padded.ravel()
+    # Half height of each column of the disk footprint
+    offsets = np.arange(-radius, radius+1)
+    heights = [int(np.sqrt(radius**2-dx**2)) for dx in offsets]
+    area = int(np.sum(2*np.array(heights)+1))
+    # Lookup tables of c*log2(c) and of its variation when a count goes up or down
+    counts = np.arange(area+2)
+    lut = np.zeros(area+2)
+    lut[1:] = counts[1:]*np.log2(counts[1:])
+    up = np.zeros(area+2)
+    up[:-1] = lut[1:]-lut[:-1]
+    down = np.zeros(area+2)
+    down[1:] = lut[:-1]-lut[1:]
+    log_lut = np.zeros(area+1)
+    log_lut[1:] = np.log2(counts[1:-1])
+    # One histogram per output column of every stripe
+    size = nb_stripes*num_columns
+    grid = ((np.arange(nb_stripes)*stripe_rows)[:, None]*padded_columns+np.arange(num_columns)[None, :]).ravel()
+    base = np.arange(size)*nb_levels
+    hist = np.zeros(size*nb_levels, dtype=np.intp)
+    for dx, h in zip(offsets, heights):
+        rows = (radius+np.arange(-h, h+1))*padded_columns+radius+dx
+        hist += np.bincount((base+padded[grid[None, :]+rows[:, None]]).ravel(), minlength=len(hist))
+    total = lut[hist].reshape(size, nb_levels).sum(axis=1)
+    information = np.empty((nb_stripes, stripe_rows, num_columns))
+    outside = base+bins
+    index = np.empty(size, dtype=np.intp)
+    count = np.empty(size, dtype=np.intp)
+    for y in range(stripe_rows):
+        if y > 0:
+            # Drops the pixels leaving the footprint and adds the ones entering it, column by column
+            for dx, h in zip(offsets, heights):
+                np.add(base, padded[grid+((radius+y-1-h)*padded_columns+radius+dx)], out=index)
+                np.take(hist, index, out=count)
+                total += down[count]
+                count -= 1
+                hist[index] = count
+                np.add(base, padded[grid+((radius+y+h)*padded_columns+radius+dx)], out=index)
+                np.take(hist, index, out=count)
+                total += up[count]
+                count += 1
+                hist[index] = count
+        count_outside = hist[outside]
+        population = area-count_outside
+        # H = log2(n) - sum(c*log2(c))/n over the levels inside the image, the padding rows below the image
+        # (population of zero) are dropped at the end
+        values = log_lut[population]-np.divide(total-lut[count_outside], population, out=np.zeros(size), where=population > 0)
+        information[:, y] = values.reshape(nb_stripes, num_columns)
+    return information.reshape(-1, num_columns)[:num_rows]
+
+
+def stripe_entropy(stripe, radius, bins, start, stop):
+    """
+    Stripe entropy computation function
+
+    :param stripe: horizontal stripe of the image, halo rows included
+    :param radius: radius of the disk footprint
+    :param bins: number of grey levels used for the entropy
+    :param start: first row of the stripe to keep (halo excluded)
+    :param stop: row after the last row to keep (halo excluded)
+    :return: local entropy of the stripe without its halo
+    """
+    return local_entropy(stripe, radius, bins)[start:stop]
+
+
+def entropy_map(image, radius=FOOTPRINT_RADIUS, workers=1, bins=256):
+    """
+    Local entropy computation function
+
+    :param image: input grayscale image
+    :param radius: radius of the disk footprint
+    :param workers: number of processes sharing the computation
+    :param bins: number of grey levels used for the entropy
+    :return: local entropy map of the whole image
+    """
+    image = img_as_ubyte(image)
+    num_rows = image.shape[0]
+    if workers <= 1 or num_rows < 2*workers:
+        return local_entropy(image, radius, bins)
+    # Splits the image into horizontal stripes, each one extended by a halo
+    # of the footprint radius so that the stitched result matches the single-process map (up to the
+    # rounding of the running sums of the sliding histograms, about 1e-13)
+    bounds = np.linspace(0, num_rows, workers+1).astype(int)
+    stripes, starts, stops = [], [], []
+    for top, bottom in zip(bounds[:-1], bounds[1:]):
+        low = max(top-radius, 0)
+        high = min(bottom+radius, num_rows)
+        stripes.append(image[low:high])
+        starts.append(top-low)
+        stops.append(bottom-low)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(stripe_entropy, stripes, [radius]*workers, [bins]*workers, starts, stops)
+        return np.vstack(list(results))
+
+
+def block_grid(values, mask_size):
+    """
+    Block averaging function
+
+    :param values: 2D map of per-pixel values (e.g. local entropy)
+    :param mask_size: the size of the mask
+    :return: 2D grid with the average value of every complete block
+    """
+    num_rows, num_columns = values.shape
+    num_steps_rows = num_rows//mask_size
+    num_steps_columns = num_columns//mask_size
+    blocks = values[:num_steps_rows*mask_size, :num_steps_columns*mask_size]
+    blocks = blocks.reshape(num_steps_rows, mask_size, num_steps_columns, mask_size)
+    return blocks.mean(axis=(1, 3))
+
+
+def block_means(values, mask_size):
+    """
+    Per-block averaging function
+
+    :param values: 2D map of per-pixel values (e.g. local entropy)
+    :param mask_size: the size of the mask
+    :return: the average value of each block, in the same order as moving_mask
+    """
+    # Like moving_mask, the last row and column of blocks are left out
+    return block_grid(values, mask_size)[:-1, :-1].ravel()
+
+
+def integral_map(values):
+    """
+    Summed-area table building function
+
+    :param values: 2D map of per-pixel values (e.g. local entropy)
+    :return: Summed-area table of the map, with a leading row and column of zeros
+    """
+    table = np.zeros((values.shape[0]+1, values.shape[1]+1))
+    np.cumsum(values, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def block_means_from_integral(table, mask_size):
+    """
+    Per-block averaging function using a summed-area table
+
+    :param table: Summed-area table returned by integral_map
+    :param mask_size: the size of the mask
+    :return: the average value of each block, in the same order as moving_mask
+    """
+    num_rows, num_columns = table.shape[0]-1, table.shape[1]-1
+    # Corners of the blocks, the last row and column of blocks being left out like in moving_mask
+    rows = np.arange(max(num_rows//mask_size, 1))*mask_size
+    columns = np.arange(max(num_columns//mask_size, 1))*mask_size
+    corners = table[np.ix_(rows, columns)]
+    sums = corners[1:, 1:]-corners[:-1, 1:]-corners[1:, :-1]+corners[:-1, :-1]
+    return (sums/mask_size**2).ravel()
+
+
+def entropy_pyramid(image, list_mask_sizes, radius=FOOTPRINT_RADIUS, workers=1, bins=256):
+    """
+    Multi-scale block entropy extraction function: the local entropy is computed once,
+    then every mask size is read from its summed-area table
+
+    :param image: input grayscale image
+    :param list_mask_sizes: List of mask sizes
+    :param radius: radius of the disk footprint
+    :param workers: number of processes used for the local entropy
+    :param bins: number of grey levels used for the entropy
+    :return: Dictionary mapping each mask size to its normalized entropy values
+    """
+    table = integral_map(entropy_map(image, radius, workers, bins))
+    pyramid = {}
+    for mask_size in list_mask_sizes:
+        pyramid[mask_size] = normalize_blocks(block_means_from_integral(table, mask_size))
+    return pyramid
+
+
+def normalize_blocks(information):
+    """
+    Entropy values normalization function
+
+    :param information: array of average entropy values
+    :return: the normalized entropy values
+    """
+    if len(information) == 0:
+        return information
+    return (information-np.min(information))/np.max(information)
+
+
+def extract_blocks(image, mask_size, radius=FOOTPRINT_RADIUS, workers=1, bins=256):
+    """
+    Block entropy extraction function: the local entropy is computed once on
+    the whole image, then averaged over each block of the moving mask
+
+    :param image: input grayscale image
+    :param mask_size: the size of the mask
+    :param radius: radius of the disk footprint
+    :param workers: number of processes used for the local entropy
+    :param bins: number of grey levels used for the entropy
+    :return: a list of normalized average entropy value for each block
+    """
+    return normalize_blocks(block_means(entropy_map(image, radius, workers, bins), mask_size))
+
+
 def pre_process(image_path):
     """
     Image loading function
 
     :param image_path: Path of the image to load
-    :return: Grayscale version of the image
+    :return: 8 bits grayscale version of the image
+    """
+    return to_gray(open_image(image_path))
+
+
+def open_image(image_path):
+    """
+    Lazy image opening function
+
+    :param image_path: Path of the image to open
+    :return: Array-like image, memory-mapped when the format allows it (npy, uncompressed TIFF)
+    """
+    extension = os.path.splitext(image_path)[1].lower()
+    if extension == '.npy':
+        return np.load(image_path, mmap_mode='r')
+    if extension in ['.tif', '.tiff']:
+        try:
+            return tifffile.memmap(image_path, mode='r')
+        except ValueError:
+            # Compressed or tiled TIFF files cannot be memory-mapped
+            pass
+    return io.imread(image_path)
+
+
+def to_gray(band, chunk_rows=256):
+    """
+    Grayscale conversion function, using the luminance weights of rgb2gray in integer arithmetic
+
+    :param band: Band of an image (grayscale, RGB or RGBA), possibly memory-mapped
+    :param chunk_rows: Number of rows converted at once
+    :return: 8 bits grayscale version of the band
+    """
+    if band.ndim == 2:
+        return img_as_ubyte(np.asarray(band))
+    gray = np.empty(band.shape[:2], dtype=np.uint8)
+    # Converts by chunks of rows so that temporaries stay small
+    for top in range(0, band.shape[0], chunk_rows):
+        chunk = np.asarray(band[top:top+chunk_rows, :, :3])
+        if chunk.dtype != np.uint8:
+            chunk = img_as_ubyte(chunk)
+        chunk = chunk.astype(np.uint32)
+        luminance = chunk[..., 0]*LUMINANCE_WEIGHTS[0]+chunk[..., 1]*LUMINANCE_WEIGHTS[1]+chunk[..., 2]*LUMINANCE_WEIGHTS[2]
+        gray[top:top+chunk_rows] = (luminance+5000)//10000
+    return gray
+
+
+def read_bands(image_path, band_rows, halo=0):
+    """
+    Streaming image reading function
+
+    :param image_path: Path of the image to read
+    :param band_rows: Number of rows of each band
+    :param halo: Number of extra rows read above and below each band
+    :return: Generator of (grayscale band, first row to keep, row after the last row to keep)
     """
-    image = io.imread(image_path)
-    image = rgb2gray(image)
-    return image
+    image = open_image(image_path)
+    num_rows = image.shape[0]
+    for top in range(0, num_rows, band_rows):
+        bottom = min(top+band_rows, num_rows)
+        low = max(top-halo, 0)
+        high = min(bottom+halo, num_rows)
+        yield to_gray(image[low:high]), top-low, bottom-low
+
+
+def extract_blocks_from_bands(bands, mask_size, radius=FOOTPRINT_RADIUS, bins=256):
+    """
+    Streaming block entropy extraction function
+
+    :param bands: Iterable of (grayscale band, first row to keep, row after the last row to keep),
+                  the bands being extended by a halo of at least radius rows
+    :param mask_size: the size of the mask
+    :param radius: radius of the disk footprint
+    :param bins: number of grey levels used for the entropy
+    :return: a list of normalized average entropy value for each block
+    """
+    grid = []
+    pending = None
+    for band, start, stop in bands:
+        values = local_entropy(band, radius, bins)[start:stop]
+        # Prepends the rows left over from the previous band
+        if pending is not None:
+            values = np.vstack([pending, values])
+        complete = (values.shape[0]//mask_size)*mask_size
+        if complete > 0:
+            grid.append(block_grid(values[:complete], mask_size))
+        pending = values[complete:]
+    if len(grid) == 0:
+        return np.array([])
+    # Like moving_mask, the last row and column of blocks are left out
+    grid = np.vstack(grid)[:-1, :-1]
+    return normalize_blocks(grid.ravel())
+
+
+def extract_blocks_streaming(image_path, mask_size, band_rows, radius=FOOTPRINT_RADIUS, bins=256):
+    """
+    Block entropy extraction function with bounded memory
+
+    :param image_path: Path of the image to analyse
+    :param mask_size: the size of the mask
+    :param band_rows: Number of rows read at once
+    :param radius: radius of the disk footprint
+    :param bins: number of grey levels used for the entropy
+    :return: a list of normalized average entropy value for each block
+    """
+    bands = read_bands(image_path, band_rows, halo=radius)
+    return extract_blocks_from_bands(bands, mask_size, radius, bins)
+
+
+def high_frequency_mask(mask_size, cutoff=0.25):
+    """
+    Spectral mask building function
+
+    :param mask_size: the size of the mask
+    :param cutoff: Spatial frequency (in cycles per pixel) above which energy is counted as high frequency
+    :return: Boolean mask over the rfft2 coefficients of a block
+    """
+    rows = np.fft.fftfreq(mask_size)[:, None]
+    columns = np.fft.rfftfreq(mask_size)[None, :]
+    return np.sqrt(rows**2+columns**2) > cutoff
+
+
+def extract_features(image_path, mask_size, radius=FOOTPRINT_RADIUS, bins=256, band_blocks=8, edge_threshold=0.1):
+    """
+    Fused multi-feature extraction function: the image is read once, by bands of block rows,
+    and every feature of a band is computed before moving to the next one
+
+    :param image_path: Path of the image to analyse
+    :param mask_size: the size of the mask
+    :param radius: radius of the disk footprint
+    :param bins: number of grey levels used for the entropy
+    :param band_blocks: number of block rows read at once
+    :param edge_threshold: Sobel magnitude above which a pixel counts as an edge
+    :return: structured array (FEATURES_DTYPE) with, for each block in the same order as moving_mask,
+             the normalized average entropy, the edge density, the variance of each colour channel
+             and the share of spectral energy in high frequencies
+    """
+    image = open_image(image_path)
+    num_rows, num_columns = image.shape[:2]
+    num_steps_rows = max(num_rows//mask_size-1, 0)
+    num_steps_columns = max(num_columns//mask_size-1, 0)
+    width = num_steps_columns*mask_size
+    features = np.zeros((num_steps_rows, num_steps_columns), dtype=FEATURES_DTYPE)
+    spectral_mask = high_frequency_mask(mask_size)
+    for first in range(0, num_steps_rows, band_blocks):
+        last = min(first+band_blocks, num_steps_rows)
+        top, bottom = first*mask_size, last*mask_size
+        low, high = max(top-radius, 0), min(bottom+radius, num_rows)
+        color = np.asarray(image[low:high])
+        gray = to_gray(color)
+        # Local entropy and Sobel edges need the halo, the other features do not
+        information = local_entropy(gray, radius, bins)[top-low:bottom-low, :width]
+        features['entropy'][first:last] = block_grid(information, mask_size)
+        edges = sobel(gray)[top-low:bottom-low, :width] > edge_threshold
+        features['edges'][first:last] = block_grid(edges, mask_size)
+        # Blocks as an array of shape (block rows, block columns, mask_size, mask_size[, channels])
+        color = color[top-low:bottom-low, :width]
+        if color.ndim == 2:
+            color = color[..., None]
+        color = color[..., :3].reshape(last-first, mask_size, num_steps_columns, mask_size, -1)
+        color = color.transpose(0, 2, 1, 3, 4)
+        if color.dtype != np.uint8:
+            color = img_as_ubyte(color)
+        features['variance'][first:last] = (color/255.).var(axis=(2, 3))
+        blocks = gray[top-low:bottom-low, :width].reshape(last-first, mask_size, num_steps_columns, mask_size)
+        spectrum = np.abs(np.fft.rfft2(blocks.transpose(0, 2, 1, 3)/255.))**2
+        # The DC coefficient (mean brightness) is left out of the total energy
+        spectrum[..., 0, 0] = 0
+        total = spectrum.sum(axis=(2, 3))
+        high_energy = spectrum[..., spectral_mask].sum(axis=-1)
+        features['spectral'][first:last] = np.divide(high_energy, total, out=np.zeros_like(total), where=total > 0)
+    features = features.ravel()
+    features['entropy'] = normalize_blocks(features['entropy'])
+    return features
+
+
+def read_frames(source):
+    """
+    Frame sequence reading function
+
+    :param source: Directory of frames (read in name order) or video file
+    :return: Generator of 8 bits grayscale frames
+    """
+    if os.path.isdir(source):
+        for file in sorted(os.listdir(source)):
+            if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
+                yield pre_process(os.path.join(source, file))
+    else:
+        # Decoding videos requires an imageio backend (e.g. imageio-ffmpeg or pyav)
+        import imageio.v3 as iio
+        for frame in iio.imiter(source):
+            yield to_gray(frame)
+
+
+class Frame_Analyser:
+
+    def __init__(self, mask_size, threshold, radius=FOOTPRINT_RADIUS, bins=256):
+        """
+        Incremental frame analysis initialization function
+
+        :param mask_size: the size of the mask
+        :param threshold: Mean absolute grey level difference above which a tile is analysed again
+        :param radius: radius of the disk footprint
+        :param bins: number of grey levels used for the entropy
+        :return: an initialized frame analyser
+        """
+        self.mask_size = mask_size
+        self.threshold = threshold
+        self.radius = radius
+        self.bins = bins
+        self.reference = None
+        self.grid = None
+
+
+    def tile_differences(self, frame):
+        """
+        Tile difference index function
+
+        :param frame: 8 bits grayscale frame
+        :return: Mean absolute difference of each tile with its last analysed version
+        """
+        difference = np.abs(frame.astype(np.int16)-self.reference.astype(np.int16))
+        return block_grid(difference, self.mask_size)[:self.grid.shape[0], :self.grid.shape[1]]
+
+
+    def update(self, frame):
+        """
+        Frame analysis function, only the tiles that changed since their last analysis, and their neighbours whose border
+        values depend on them, are recomputed
+
+        :param frame: 8 bits grayscale frame
+        :return: the average entropy value for each block (not normalized) and the number of tiles recomputed
+        """
+        size = self.mask_size
+        if self.reference is None or self.reference.shape != frame.shape:
+            # First frame: the whole frame is analysed
+            self.reference = frame.copy()
+            self.grid = block_grid(entropy_map(frame, self.radius, bins=self.bins), size)[:-1, :-1]
+            return self.grid.ravel().copy(), self.grid.size
+        changed = self.tile_differences(frame) > self.threshold
+        # The footprint of the pixels near a tile border reaches into the neighbouring tiles
+        for k in range(-(-self.radius//size)):
+            dilated = changed.copy()
+            dilated[1:] |= changed[:-1]
+            dilated[:-1] |= changed[1:]
+            changed = dilated.copy()
+            changed[:, 1:] |= dilated[:, :-1]
+            changed[:, :-1] |= dilated[:, 1:]
+        num_rows, num_columns = frame.shape
+        for row in np.flatnonzero(changed.any(axis=1)):
+            columns = np.flatnonzero(changed[row])
+            # Analyses the span of changed tiles of this row, extended by a halo
+            top, bottom = row*size, (row+1)*size
+            left, right = columns[0]*size, (columns[-1]+1)*size
+            low, high = max(top-self.radius, 0), min(bottom+self.radius, num_rows)
+            first, last = max(left-self.radius, 0), min(right+self.radius, num_columns)
+            information = local_entropy(frame[low:high, first:last], self.radius, self.bins)
+            information = information[top-low:bottom-low, left-first:right-first]
+            means = block_grid(information, size)[0]
+            for column in columns:
+                self.grid[row, column] = means[column-columns[0]]
+                self.reference[top:bottom, column*size:(column+1)*size] = frame[top:bottom, column*size:(column+1)*size]
+        return self.grid.ravel().copy(), int(np.sum(changed))
+
+
+def extract_frame_blocks(source, mask_size, threshold, radius=FOOTPRINT_RADIUS, bins=256):
+    """
+    Frame sequence entropy extraction function
+
+    :param source: Directory of frames or video file
+    :param mask_size: the size of the mask
+    :param threshold: Mean absolute grey level difference above which a tile is analysed again
+    :param radius: radius of the disk footprint
+    :param bins: number of grey levels used for the entropy
+    :return: a list of normalized average entropy value for each frame
+    """
+    analyser = Frame_Analyser(mask_size, threshold, radius, bins)
+    information = []
+    for i, frame in enumerate(read_frames(source)):
+        list_blocks, nb_recomputed = analyser.update(frame)
+        print('Frame', i, ':', nb_recomputed, '/', len(list_blocks), 'tiles analysed')
+        if len(list_blocks) > 0:
+            information.append(np.mean(list_blocks))
+    return normalize_blocks(np.array(information))
+
 
 def test_print(image):
     """
@@ -68,7 +584,7 @@ def test_print(image):
     ax0.axis("off")
     fig.colorbar(img0, ax=ax0)
 
-    img1 = ax1.imshow(entropy(image, disk(10)), cmap='gray')
+    img1 = ax1.imshow(entropy(image, disk(FOOTPRINT_RADIUS)), cmap='gray')
     ax1.set_title("Entropy")
     ax1.axis("off")
     fig.colorbar(img1, ax=ax1)
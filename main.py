@@ -1,6 +1,12 @@
 import click
 from sound_module import *
 from image_processing import *
+from feature_cache import *
+from score import *
+from metrics import *
+from governor import *
+from engine import *
+from scheduler import *
 import random
 
 
@@ -19,6 +25,27 @@ import random
 @click.option("--record",type=bool,default=False)
 @click.option("--normalize",type=bool,default=True)
 @click.option("--verbose", type=int, default=0)
+@click.option("--workers", type=int, default=1)
+@click.option("--band-rows", type=int, default=0)
+@click.option("--cache-dir", type=str, default=os.path.join(os.path.expanduser('~'), '.cache', 'hearwydns'))
+@click.option("--cache-mb", type=int, default=256)
+@click.option("--no-cache", is_flag=True)
+@click.option("--bins", type=int, default=256)
+@click.option("--frame-threshold", type=float, default=2.)
+@click.option("--features", is_flag=True)
+@click.option("--record-path", type=str, default=os.path.join(os.path.expanduser('~'), 'Desktop', 'test.wav'))
+@click.option("--render", type=str, default=None)
+@click.option("--sample-cache-mb", type=int, default=512)
+@click.option("--seed", type=int, default=None)
+@click.option("--score", "score_path", type=str, default=None)
+@click.option("--save-score", "save_score_path", type=str, default=None)
+@click.option("--metrics", "metrics_path", type=str, default=None)
+@click.option("--calibrate", type=float, default=0.)
+@click.option("--shared-buses", is_flag=True)
+@click.option("--cpu-budget", type=float, default=0.)
+@click.option("--split-groups", is_flag=True)
+@click.option("--control-tables", is_flag=True)
+@click.option("--lookahead", type=int, default=0)
 
 
 def main(
@@ -35,49 +62,144 @@ def main(
     shuffle,
     record,
     normalize,
-    verbose
+    verbose,
+    workers,
+    band_rows,
+    cache_dir,
+    cache_mb,
+    no_cache,
+    bins,
+    frame_threshold,
+    features,
+    record_path,
+    render,
+    sample_cache_mb,
+    seed,
+    score_path,
+    save_score_path,
+    metrics_path,
+    calibrate,
+    shared_buses,
+    cpu_budget,
+    split_groups,
+    control_tables,
+    lookahead
 ):
-    # Image processing initialization
-    image = pre_process(image_path)
+    list_features = None
+    list_blocks = None
+    score = None
+    if split_groups and (metrics_path or calibrate > 0 or cpu_budget > 0):
+        raise click.UsageError('--metrics, --calibrate and --cpu-budget measure a single server, they cannot be used with --split-groups')
+    if seed is not None:
+        # Seeds the shuffling of the entropy values too, so that the whole run is reproducible
+        random.seed(seed)
+        np.random.seed(seed)
+    if score_path:
+        # Replays a saved score: image analysis and conductors construction are skipped
+        score = load_score(score_path)
+    elif os.path.isdir(image_path) or os.path.splitext(image_path)[1].lower() not in IMAGE_EXTENSIONS:
+        # Frame sequence or video: one time-step per frame, in order
+        list_blocks = extract_frame_blocks(image_path, mask_size, frame_threshold, bins=bins)
+    else:
+        if features:
+            # Extracts entropy, edge density, colour variance and spectral energy in one pass
+            list_features = extract_features(image_path, mask_size, bins=bins)
+            list_blocks = list_features['entropy']
+        elif not no_cache:
+            # Looks for the entropy values of this image in the feature cache
+            cache = Feature_Cache(cache_dir, cache_mb*1024*1024)
+            key = cache.key(image_path, mask_size, FOOTPRINT_RADIUS, normalize, bins)
+            list_blocks = cache.load(key)
+        if list_blocks is None:
+            if band_rows > 0:
+                # Streams the image by bands of rows to bound memory usage
+                list_blocks = extract_blocks_streaming(image_path, mask_size, band_rows, bins=bins)
+            elif not no_cache:
+                # The local entropy map does not depend on the mask size, every mask size is read from its summed-area
+                # table. The map is stored in single precision, half the size of the table, which is rebuilt at load
+                map_key = cache.map_key(image_path, FOOTPRINT_RADIUS, bins)
+                information = cache.load(map_key)
+                if information is None:
+                    information = entropy_map(pre_process(image_path), FOOTPRINT_RADIUS, workers, bins).astype(np.float32)
+                    cache.save(map_key, information)
+                list_blocks = normalize_blocks(block_means_from_integral(integral_map(information), mask_size))
+            else:
+                # Image processing initialization
+                image = pre_process(image_path)
 
-    # Extraction of sub-regions and entropy values
-    list_regions, nb_regions = moving_mask(image, mask_size)
-    list_blocks = extract_from_mask(list_regions)
-    # Random shuffling of the extracted values, you can comment or uncomment this following line
-    # if you want the list to be shuffled or not
-    if shuffle:
-        list_blocks = random.sample(list(list_blocks), len(list_blocks))
+                # Extraction of sub-regions and entropy values
+                list_blocks = extract_blocks(image, mask_size, workers=workers, bins=bins)
+            if not no_cache:
+                cache.save(key, list_blocks)
+        # Random shuffling of the extracted values, you can comment or uncomment this following line
+        # if you want the list to be shuffled or not
+        if shuffle:
+            order = random.sample(range(len(list_blocks)), len(list_blocks))
+            list_blocks = list(np.asarray(list_blocks)[order])
+            if list_features is not None:
+                list_features = list_features[order]
+
+    if split_groups:
+        # Each group of instruments is played by its own process, all of them from the same seed
+        if seed is None and score is None:
+            seed = random.randrange(2**32)
+        args = ([nb_grn, nb_clouds], samples_dir_1, samples_dir_2, samples_dir_3, samples_dir_4, list_blocks, middle, std, False, normalize, list_features)
+        kwargs = {'sample_cache_bytes':sample_cache_mb*1024*1024, 'seed':seed, 'score':score, 'shared_buses':shared_buses, 'control_tables':control_tables, 'lookahead':lookahead if lookahead > 0 else None}
+        if render:
+            print('Rendering performance to', render, 'in', len(GROUPS), 'processes ...')
+            render_parallel(args, kwargs, render, score_path=save_score_path, verbose=verbose)
+        else:
+            print('Starting performance in', len(GROUPS), 'processes ...')
+            play_parallel(args, kwargs, score_path=save_score_path, verbose=verbose, record_path=record_path if record else None)
+        return
 
     # Sound module initialization
-    sound = Sound_Module([nb_grn, nb_clouds], samples_dir_1, samples_dir_2, samples_dir_3, samples_dir_4, list_blocks, middle, std, record, normalize)
+    sound = Sound_Module([nb_grn, nb_clouds], samples_dir_1, samples_dir_2, samples_dir_3, samples_dir_4, list_blocks, middle, std, record, normalize, list_features,
+                         render if render else record_path, offline=bool(render), sample_cache_bytes=sample_cache_mb*1024*1024, seed=seed, score=score, shared_buses=shared_buses, control_tables=control_tables,
+                         lookahead=lookahead if lookahead > 0 else None)
+    if save_score_path:
+        save_score(save_score_path, sound)
+    if metrics_path:
+        # Writes server load and underruns at each time-step, as newline-delimited JSON (no underrun when rendering offline)
+        sound.metrics = Server_Metrics(sound.s, metrics_path, realtime=not render)
+    if cpu_budget > 0:
+        # Caps the instruments playing to the CPU budget, the server load is needed
+        if sound.metrics is None:
+            sound.metrics = Server_Metrics(sound.s, realtime=not render)
+        sound.governor = Voice_Governor(cpu_budget)
+
+
+    if render:
+        # Offline rendering, faster than real-time
+        print('Rendering performance to', render, '...')
+        sound.render(verbose)
+        return
 
+    if calibrate > 0:
+        if sound.metrics is None:
+            sound.metrics = Server_Metrics(sound.s, '-')
+        # Measures the cost of each instrument chain before they are heard
+        print('Calibrating ...')
+        sound.s.start()
+        costs = sound.metrics.calibrate(sound, calibrate)
+        if sound.governor is not None:
+            # The governor uses the measured cost of each instrument
+            sound.governor.costs = {name: cost['load'] for name, cost in costs['instruments'].items()}
 
     # Performance start
     print('Warming up ...')
     sound.start()
     print('Starting performance ...')
-    for i in range(sound.TOTAL):
-        print('----------------------------------------------')
-        # printing the current iteration
-        print('I=',i, '/', sound.TOTAL)
-        # printing current value of entropy
-        print('Current entropy value :', sound.list_blocks[i])
-        # printing instruments currently playing
-        if verbose>0:
-            sound.get_instruments_playing(i)
-        # reading the conductor
-        sound.read_conductor(i)
-        # reading the melodic conductor
-        sound.read_melodic_conductor(i)
-        # updating the cloud instruments
-        sound.update_cloud(i)
-        # reading the granular conductor
-        sound.read_grn_conductor(i)
-        # pausing before next iteration
-        time.sleep(sound.update_time(i))
+    # The start of each time-step is fixed in advance, so that playing them does not make the performance drift
+    scheduler = Step_Scheduler(sound.wait_times[:sound.TOTAL])
+    scheduler.run(lambda i: sound.play_step(i, verbose))
 
     # Performance end
     sound.stop()
+    jitter = scheduler.jitter()
+    print('Time-steps lateness (ms) :', jitter)
+    if sound.metrics is not None:
+        sound.metrics.write({'jitter':jitter})
     
 if __name__ == "__main__":
     main()
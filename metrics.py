@@ -0,0 +1,179 @@
+from pyo64 import *
+import json
+import sys
+import time
+
+
+# A buffer is counted as an underrun when it comes later than this many buffer durations after the previous one
+UNDERRUN_FACTOR = 1.5
+
+
+def instrument_chain(instrument, shared=()):
+    """
+    Instrument chain collecting function: walks the pyo objects an instrument is built from
+
+    :param instrument: Dictionary of an instrument (see Sound_Module.init_instruments)
+    :param shared: Pyo objects shared with other instruments, left out of the chain with their inputs
+    :return objects: List of the pyo objects of the chain that can be stopped and played
+    """
+    # The timer only runs scheduled calls, it is not part of the sound chain
+    stack = [value for key, value in instrument.items() if key not in ('timer', 'pending', 'chain')]
+    seen = set(id(obj) for obj in shared)
+    objects = []
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+            continue
+        if not isinstance(obj, PyoObjectBase) or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, PyoObject):
+            objects.append(obj)
+        # Inputs of an object are kept in its attributes
+        stack.extend(vars(obj).values())
+    return objects
+
+
+class Server_Metrics:
+
+    def __init__(self, server, path=None, realtime=True):
+        """
+        Server metrics initialization function, the server calls the metrics at each buffer
+
+        :param server: Booted pyo server
+        :param path: Path of the newline-delimited JSON file to write, '-' for the standard output, None to only sample the metrics
+        :param realtime: Boolean indicating whether the server is paced by the audio device, the underruns are not counted
+                         (written as null) for an offline server, which computes its buffers as fast as it can
+        :return: initialized server metrics
+        """
+        self.server = server
+        self.realtime = realtime
+        self.period = server.getBufferSize()/server.getSamplingRate()
+        if path is None:
+            self.file = None
+        elif path == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(path, 'w')
+        # Last sampled metrics
+        self.last = None
+        self.last_buffer = None
+        self.buffers = 0
+        self.underruns = 0
+        self.total_underruns = 0
+        self.max_interval = 0.
+        self.last_wall = time.perf_counter()
+        self.last_cpu = time.process_time()
+        server.setCallback(self.tick)
+
+
+    def tick(self):
+        """
+        Buffer callback function, called by the server before computing each buffer
+
+        :param:
+        :return:
+        """
+        now = time.perf_counter()
+        if self.last_buffer is not None:
+            interval = now-self.last_buffer
+            self.max_interval = max(self.max_interval, interval)
+            # A late buffer means the audio device was not fed in time
+            if self.realtime and interval > UNDERRUN_FACTOR*self.period:
+                self.underruns += 1
+                self.total_underruns += 1
+        self.last_buffer = now
+        self.buffers += 1
+        return
+
+
+    def write(self, record):
+        """
+        Record writing function
+
+        :param record: Dictionary to write as one JSON line
+        :return:
+        """
+        if self.file is not None:
+            self.file.write(json.dumps(record)+'\n')
+            self.file.flush()
+        return
+
+
+    def sample(self):
+        """
+        Metrics sampling function, the counters are reset at each call
+
+        :param:
+        :return: Dictionary containing the process CPU load, the CPU time spent per second of audio computed (1 is the
+                 real-time limit), the speed of the server relative to real-time, the number of buffers and underruns
+                 (None for an offline server) and the longest interval between buffers since the last call
+        """
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        elapsed = max(wall-self.last_wall, 1e-9)
+        audio = self.buffers*self.period
+        record = {'cpu':(cpu-self.last_cpu)/elapsed,
+                  'load':(cpu-self.last_cpu)/audio if audio > 0 else 0.,
+                  'speed':audio/elapsed,
+                  'buffers':self.buffers,
+                  'underruns':self.underruns if self.realtime else None,
+                  'total_underruns':self.total_underruns if self.realtime else None,
+                  'max_buffer_interval':self.max_interval,
+                  'streams':self.server.getNumberOfStreams()}
+        self.last_wall, self.last_cpu = wall, cpu
+        self.buffers = 0
+        self.underruns = 0
+        self.max_interval = 0.
+        self.last = record
+        return record
+
+
+    def step(self, i, sound):
+        """
+        Time-step metrics function, writes one JSON line per time-step
+
+        :param i: Current time-step
+        :param sound: Sound module playing the time-step
+        :return:
+        """
+        record = {'step':i, 'entropy':float(sound.list_blocks[i])}
+        record.update(self.sample())
+        record['playing'] = [name for name in sound.conductor if name in sound.active]
+        if sound.governor is not None:
+            record['stolen'] = sorted(sound.governor.stolen)
+        self.write(record)
+        return
+
+
+    def calibrate(self, sound, duration=2.):
+        """
+        Calibration pass: measures the load of the server (CPU time per second of audio) with every instrument chain,
+        then with each one stopped in turn. The server must be running and the instruments silent (before Sound_Module.start_all)
+
+        :param sound: Sound module whose instruments are measured
+        :param duration: Time, in seconds, of each measure
+        :return costs: Dictionary containing the load of all the chains, the load with none of them and the estimated cost of each instrument
+        """
+        chains = {name: instrument['chain'] for name, instrument in sound.instruments.items()}
+        def measure():
+            self.sample()
+            time.sleep(duration)
+            return self.sample()['load']
+        costs = {'all':measure(), 'instruments':{}}
+        for name, chain in chains.items():
+            for obj in chain:
+                obj.stop()
+            costs['instruments'][name] = {'kind':sound.roster[name], 'load':max(costs['all']-measure(), 0.)}
+            for obj in chain:
+                obj.play()
+        for chain in chains.values():
+            for obj in chain:
+                obj.stop()
+        costs['none'] = measure()
+        for chain in chains.values():
+            for obj in chain:
+                obj.play()
+        self.write({'calibration':costs})
+        return costs
@@ -0,0 +1,72 @@
+import numpy as np
+import time
+
+
+# Percentiles of the lateness reported at the end of a performance
+JITTER_PERCENTILES = [50, 90, 99]
+
+
+class Step_Scheduler:
+
+    def __init__(self, durations, clock=time.monotonic):
+        """
+        Time-steps scheduler initialization function: the start of every time-step is fixed in advance, relative to
+        the start of the performance, so that the time spent playing a time-step does not delay the following ones
+
+        :param durations: List of the durations, in seconds, of the time-steps (see Sound_Module.wait_times)
+        :param clock: Monotonic clock, in seconds
+        :return: an initialized scheduler
+        """
+        durations = np.asarray(durations, dtype=np.float64)
+        self.clock = clock
+        # Absolute start of each time-step, and end of the last one
+        self.times = np.concatenate(([0.], np.cumsum(durations)))
+        self.lateness = np.full(len(durations), np.nan)
+        self.origin = None
+
+
+    def run(self, action):
+        """
+        Scheduling loop: calls the action of each time-step at its start, then waits for the end of the last one.
+        A late time-step is played at once, the following ones keep their own start
+
+        :param action: Function called with the index of each time-step
+        :return:
+        """
+        self.origin = self.clock()
+        for i in range(len(self.lateness)):
+            self.wait(self.times[i])
+            # Measured delay of the time-step, after the sleep
+            self.lateness[i] = self.clock()-self.origin-self.times[i]
+            action(i)
+        self.wait(self.times[-1])
+        return
+
+
+    def wait(self, start):
+        """
+        Waiting function
+
+        :param start: Time, in seconds from the start of the performance, to wait for
+        :return:
+        """
+        delay = self.origin+start-self.clock()
+        if delay > 0:
+            time.sleep(delay)
+        return
+
+
+    def jitter(self):
+        """
+        Jitter function
+
+        :param:
+        :return: Dictionary containing the percentiles, mean and maximum of the lateness of the time-steps played, in milliseconds
+        """
+        lateness = 1000*self.lateness[~np.isnan(self.lateness)]
+        if len(lateness) == 0:
+            return {}
+        record = {'p{}'.format(p): float(value) for p, value in zip(JITTER_PERCENTILES, np.percentile(lateness, JITTER_PERCENTILES))}
+        record['mean'] = float(np.mean(lateness))
+        record['max'] = float(np.max(lateness))
+        return record
@@ -0,0 +1,57 @@
+import numpy as np
+from utils import *
+
+
+# Version of the score file layout
+SCORE_VERSION = 1
+
+
+def save_score(path, sound):
+    """
+    Score writing function: everything the sound module precomputes is saved in a columnar .npz file
+
+    :param path: Path of the .npz file to write
+    :param sound: Initialized sound module
+    :return:
+    """
+    # Builds the time-steps the conductors have not built yet
+    sound.generate(len(sound.list_blocks))
+    names = list(sound.instruments.keys())
+    grn_names = list(sound.grn_conductor.keys())
+    # Samples directories are stored as indices, so that a score can be replayed with other directories
+    dirs = [sound.samples_dir_melody, sound.samples_dir_voices, sound.samples_dir_beat, sound.samples_dir_aggressive]
+    grn_dirs = [[dirs.index(dir) for dir in sound.grn_conductor[name]['samples_file']] for name in grn_names]
+    np.savez_compressed(path,
+                        version=np.array(SCORE_VERSION),
+                        seed=np.array(sound.seed, dtype=np.int64),
+                        entropy=np.asarray(sound.list_blocks, dtype=np.float64),
+                        names=np.array(names, dtype=str),
+                        kinds=np.array([sound.roster[name] for name in names], dtype=str),
+                        thresholds=np.asarray(sound.thresholds, dtype=np.float64),
+                        conductor=np.array([sound.conductor[name] for name in names], dtype=np.float64),
+                        keys=np.asarray(sound.melody_conductor, dtype=np.int8),
+                        grn_names=np.array(grn_names, dtype=str),
+                        grn_dirs=np.array(grn_dirs, dtype=np.int8).reshape(len(grn_names), len(sound.list_blocks)),
+                        grn_duration=np.array([sound.grn_conductor[name]['duration'] for name in grn_names], dtype=np.float64).reshape(len(grn_names), len(sound.list_blocks)),
+                        grn_density=np.array([sound.grn_conductor[name]['density'] for name in grn_names], dtype=np.float64).reshape(len(grn_names), len(sound.list_blocks)),
+                        grn_reverb_wet=np.array([sound.grn_conductor[name]['reverb_wet'] for name in grn_names], dtype=np.float64).reshape(len(grn_names), len(sound.list_blocks)),
+                        wait_times=np.asarray(sound.wait_times, dtype=np.float64))
+    return
+
+
+def load_score(path):
+    """
+    Score reading function
+
+    :param path: Path of the .npz file to read
+    :return: Dictionary containing the arrays of the score
+    """
+    store = np.load(path)
+    if int(store['version']) != SCORE_VERSION:
+        raise ValueError('Unsupported score version {} in {}'.format(int(store['version']), path))
+    score = {name: store[name] for name in store.files}
+    score['seed'] = int(score['seed'])
+    score['names'] = [str(name) for name in score['names']]
+    score['kinds'] = [str(kind) for kind in score['kinds']]
+    score['grn_names'] = [str(name) for name in score['grn_names']]
+    return score
@@ -1,13 +1,87 @@
-from pyo import *
+# Double precision build of pyo: in single precision, the phase of SineLoop can wrap to the end of its table, where it
+# reads a NaN and crashes the server (the feedback of the clouds makes it happen within minutes of audio)
+from pyo64 import *
 from utils import *
+from score import *
+from metrics import instrument_chain
+from automation import *
 import os
 import random
 import time
-from collections import deque
+import builtins
+from collections import deque, OrderedDict
+
+
+# Bytes per sample of a pyo table (double precision when pyo64 is used)
+TABLE_SAMPLE_BYTES = 8 if hasattr(builtins, "pyo_use_double") else 4
+# Outputs of the shared buses mixer: the dry signal and the sends to each reverb
+BUS_OUTPUTS = {'dry':0, 'large':1, 'small':2}
+# Number of time-steps between two updates of the granular synths parameters
+GRN_UPDATE_PERIOD = 5
+# Stages of the construction and of the performance drawing from their own seed (see Sound_Module.reseed)
+SEED_STAGES = {'instruments':1, 'conductor':2, 'performance':3, 'post_process':4, 'melodic_conductor':5, 'grn_conductor':6}
+# Stages of the conductors, each one keeps its own random state while the conductors are built window by window
+CONDUCTOR_STAGES = ['conductor', 'post_process', 'melodic_conductor', 'grn_conductor']
+# Group of each kind of instrument, groups can be rendered in separate processes (see engine.py)
+INSTRUMENT_GROUPS = {'particule':'granular', 'particule2':'granular', 'cloud':'cloud', 'second_cloud':'cloud', 'bass':'bass'}
+
+
+class Sample_Table_Cache:
+
+    def __init__(self, sampling_rate, max_bytes=512*1024*1024):
+        """
+        Decoded sample tables cache initialization function
+
+        :param sampling_rate: Sampling rate of the server
+        :param max_bytes: Memory budget of the cache, least recently used tables are evicted beyond it
+        :return: an initialized sample tables cache
+        """
+        self.sampling_rate = sampling_rate
+        self.max_bytes = max_bytes
+        self.tables = OrderedDict()
+        self.sizes = {}
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, path):
+        """
+        Sample table reading function, the file is only decoded if its table is not cached
+
+        :param path: Path of the sample
+        :return: Table containing the decoded sample
+        """
+        key = (path, self.sampling_rate)
+        if key in self.tables:
+            self.hits += 1
+            self.tables.move_to_end(key)
+            return self.tables[key]
+        self.misses += 1
+        table = SndTable(path)
+        self.tables[key] = table
+        self.sizes[key] = sum(table.getSize(all=True))*TABLE_SAMPLE_BYTES
+        self.total += self.sizes[key]
+        # Evicts the least recently used tables, instruments still playing them keep their reference
+        while self.total > self.max_bytes and len(self.tables) > 1:
+            old_key, old_table = self.tables.popitem(last=False)
+            self.total -= self.sizes.pop(old_key)
+        return table
+
+
+    def stats(self):
+        """
+        Cache statistics function
+
+        :param:
+        :return: Dictionary containing the hits, misses, number of tables and bytes used
+        """
+        return {'hits':self.hits, 'misses':self.misses, 'tables':len(self.tables), 'bytes':self.total}
+
 
 class Sound_Module:
     
-    def __init__(self, list_instruments, samples_dir_melody, samples_dir_voices,samples_dir_aggressive,samples_dir_beat, list_blocks, MIDDLE, STD, record=False, normalized=False):
+    def __init__(self, list_instruments, samples_dir_melody, samples_dir_voices,samples_dir_aggressive,samples_dir_beat, list_blocks, MIDDLE, STD, record=False, normalized=False, features=None, path_record=None, offline=False, sample_cache_bytes=512*1024*1024, seed=None, score=None, shared_buses=False, groups=None, control_tables=False, lookahead=None, embedded=False):
         """
         Sound module initialization function
 
@@ -20,34 +94,99 @@ class Sound_Module:
         :param STD: Deviation of the midi notes played
         :param record: Boolean to activate recording or not
         :param normalized: Boolean to normalize the entropy values or not
+        :param features: Optional structured array of per-block features (see image_processing.extract_features), aligned with list_blocks
+        :param path_record: Path of the recorded (or rendered) file, defaults to ~/Desktop/test.wav
+        :param offline: Boolean to render the performance faster than real-time instead of playing it
+        :param sample_cache_bytes: Memory budget of the decoded sample tables cache
+        :param seed: Seed of the random generators, drawn at random if None
+        :param score: Optional score (see score.load_score) to replay, list_blocks and normalized are then ignored
+        :param shared_buses: Boolean to mix the granular synths through shared compressor and reverbs instead of their own
+        :param groups: Optional set of instrument groups (see INSTRUMENT_GROUPS) to play, the other instruments are built and
+                       conducted the same way but stay silent
+        :param control_tables: Boolean to read the volumes and granular parameters of the conductors from tables in the
+                               audio engine instead of setting them at each time-step
+        :param lookahead: Number of time-steps the conductors are built ahead of the performance, everything is built
+                          before it starts if None
+        :param embedded: Boolean to compute the audio buffer by buffer with the server's process function, for a program
+                         driving the server itself (see engine.play_group)
         :return: an initialized sound module
         """
         self.MIDDLE = MIDDLE
         self.STD = STD
-        self.s = Server().boot()
+        # Seeds the random generators, a replayed score uses its own seed
+        if score is not None:
+            seed = score['seed']
+        elif seed is None:
+            seed = random.randrange(2**32)
+        self.seed = seed
+        random.seed(seed)
+        np.random.seed(seed)
+        self.offline = offline
+        if offline:
+            # Offline server: the performance is computed as fast as possible into a sound file
+            self.s = Server(audio='offline').boot()
+        elif embedded:
+            self.s = Server(audio='manual').boot()
+        else:
+            self.s = Server().boot()
         self.home = os.path.expanduser('~')
         self.samples_dir_melody  = samples_dir_melody
         self.list_instruments = list_instruments
         self.samples_dir_voices = samples_dir_voices
         self.samples_dir_aggressive = samples_dir_aggressive
         self.samples_dir_beat = samples_dir_beat
-        self.current_key = random.choice(list(circle_of_fifths.keys()))
-        self.chords = build_chords(build_key(self.current_key))
+        if score is not None:
+            list_blocks = score['entropy']
+            self.key_index = int(score['keys'][0])
+        else:
+            self.key_index = random.randrange(len(KEYS))
+        self.current_key = KEYS[self.key_index]
+        self.chords = KEY_CHORDS[self.key_index]
         self.list_blocks = list_blocks
+        self.features = features
         self.TOTAL = len(list_blocks)
-        self.path_record = os.path.join(os.path.expanduser("~"), "Desktop", "test.wav")
+        if path_record is None:
+            path_record = os.path.join(os.path.expanduser("~"), "Desktop", "test.wav")
+        self.path_record = path_record
         self.record = record
+        print('Samples catalog initialization ...')
+        self.catalog = Sample_Catalog([samples_dir_melody, samples_dir_voices, samples_dir_aggressive, samples_dir_beat])
+        self.tables = Sample_Table_Cache(self.s.getSamplingRate(), sample_cache_bytes)
+        self.shared_buses = shared_buses
+        if shared_buses:
+            self.init_buses()
         print('Instruments initialization ...')
-        self.init_instruments()
+        self.init_instruments(None if score is None else dict(zip(score['names'], score['kinds'])))
         self.nb_instruments = len(list(self.instruments.keys()))
-        self.init_thresholds(normalized)
-        print('Conductor initialization ...')
-        self.init_conductor()
-        print('Melodic conductor initialization ...')
-        self.init_melodic_conductor()
-        print('Granular conductor initialization ...')
-        self.init_grn_conductor()
+        if score is not None:
+            print('Score reading ...')
+            self.read_score(score)
+        else:
+            self.init_thresholds(normalized)
+            self.init_conductors(lookahead)
+            self.init_wait_times()
         self.TIME_REACT = 0.1
+        # Optional timeline (see automation.Control_Timeline) reading the conductors in the audio engine
+        self.timeline = None
+        if control_tables:
+            print('Control tables initialization ...')
+            self.init_automation()
+        self.groups = groups
+        for name in self.instruments:
+            if not self.rendered(name):
+                for obj in self.instruments[name]['chain']:
+                    obj.stop()
+        if shared_buses and not (groups is None or 'granular' in groups):
+            for obj in self.buses.values():
+                obj.stop()
+        # Optional server metrics (see metrics.Server_Metrics), written at each time-step
+        self.metrics = None
+        # Optional governor (see governor.Voice_Governor) capping the instruments playing to a CPU budget
+        self.governor = None
+        # Instruments currently playing
+        self.active = set()
+        # The performance draws from its own seed, whether the conductors were built or read from a score
+        self.reseed('performance')
         print('System ready ...')
         
 
@@ -58,8 +197,9 @@ class Sound_Module:
         :param:
         :return:
         """
-        # Starts the server
-        self.s.start()
+        # Starts the server, unless it already runs (e.g. for a calibration pass)
+        if not self.s.getIsStarted():
+            self.s.start()
         # Activates the recording or not
         self.s.recordOptions(filename=self.path_record, fileformat=0, sampletype=1)
         if self.record:
@@ -79,6 +219,101 @@ class Sound_Module:
         if self.record:
             self.s.recstop()
         self.s.stop()
+        print('Sample tables cache :', self.tables.stats())
+        
+        
+    def render(self, verbose=0):
+        """
+        Offline rendering function: the whole performance is written to path_record using
+        the server's virtual clock, each time-step being scheduled after the previous one
+
+        :param verbose: Verbosity of the printed time-steps
+        :return:
+        """
+        self.s.recordOptions(dur=self.duration(), filename=self.path_record, fileformat=0, sampletype=1)
+        self.start_all()
+        self.schedule_steps(verbose)
+        # Computes the whole performance, returns when the file is written
+        self.s.start()
+        print('Sample tables cache :', self.tables.stats())
+        return
+
+
+    def duration(self):
+        """
+        Performance duration function
+
+        :param:
+        :return: Duration, in seconds, of the performance, leaving time for the last fades to end
+        """
+        return float(np.sum(self.wait_times))+100*self.TIME_REACT
+
+
+    def schedule_steps(self, verbose=0):
+        """
+        Time-steps scheduling function: plays the first time-step, the next ones are played on the server's clock
+
+        :param verbose: Verbosity of the printed time-steps
+        :return:
+        """
+        # A single timer, re-armed at each time-step, schedules the next one
+        self.next_step = CallAfter(self.render_step, time=1, arg=(0, verbose)).stop()
+        self.render_step((0, verbose))
+        return
+        
+        
+    def render_step(self, step):
+        """
+        Time-step function, called on the server's clock when the server computes the audio itself (offline or embedded)
+
+        :param step: Tuple containing the current time-step and the verbosity
+        :return:
+        """
+        i, verbose = step
+        self.play_step(i, verbose)
+        if i+1 < self.TOTAL:
+            # Schedules the next time-step after the wait time of this one
+            self.next_step.setArg((i+1, verbose))
+            self.next_step.setTime(self.wait_times[i])
+            self.next_step.play()
+        return
+        
+        
+    def play_step(self, i, verbose=0):
+        """
+        Time-step playing function
+
+        :param i: current time-step
+        :param verbose: Verbosity of the printed time-step
+        :return:
+        """
+        print('----------------------------------------------')
+        # printing the current iteration
+        print('I=',i, '/', self.TOTAL)
+        # printing current value of entropy
+        print('Current entropy value :', self.list_blocks[i])
+        # Builds the conductors ahead of the time-step
+        self.generate(i+self.lookahead)
+        # printing instruments currently playing
+        if verbose>0:
+            self.get_instruments_playing(i)
+        # The control tables are read from the start of the first time-step
+        if i == 0 and self.timeline is not None:
+            self.timeline.reset()
+        # reading the conductor
+        self.read_conductor(i)
+        # reading the melodic conductor
+        self.read_melodic_conductor(i)
+        # updating the cloud instruments
+        self.update_cloud(i)
+        # reading the granular conductor
+        self.read_grn_conductor(i)
+        # writing the metrics of the time-step
+        if self.metrics is not None:
+            self.metrics.step(i, self)
+        # printing the duration of the time-step
+        print('Wait time = ', self.wait_times[i], 's')
+        return
         
         
 
@@ -87,16 +322,18 @@ class Sound_Module:
         Granular synth initialization function
 
         :param:
-        :return: Dictionary containing 1) the out module (reverb); 2) the instrument; 3) list of previously selected samples;
-                                       4) the table to read; 5) inner counter
+        :return: Dictionary containing 1) the out module (reverb, or the voice itself with shared buses); 2) the instrument;
+                                       3) list of previously selected samples; 4) the table to read; 5) inner counter; 6) the gain ramp;
+                                       7) the pending scheduled call; with shared buses, 8) the reverb bus and 9) the initial reverb balance
         """
         dir = random.choice([self.samples_dir_melody, self.samples_dir_voices])
-        sample = select_sample_by_key(dir, self.chords)
+        sample = self.catalog.select_by_key(dir, self.chords)
+        if sample is None:
+            sample = self.catalog.select(dir)
         sample_old = deque(maxlen=5)
         sample_old.append(sample)
-        snd = SndTable()
         path = os.path.join(dir, sample)
-        snd.setSound(path)
+        snd = self.tables.get(path)
         end = snd.getSize() - self.s.getSamplingRate() * 0.25
         env = WinTable(7)
         pit = Noise(0, add=1)
@@ -106,6 +343,7 @@ class Sound_Module:
         pan = Noise(mul=0.5, add=0.5)
         cf = Sine(freq=0.07).range(75, 125)
         fcf = Choice(list(range(1, 40)), freq=150, mul=cf)
+        gain = SigTo(value=0, init=0)
         grn = Particle2(
             table=snd,  # The table to read.
             env=env,  # The grain envelope.
@@ -120,9 +358,13 @@ class Sound_Module:
             filtertype=2,  # The filter type of the grain.
             chnls=2,  # The output number of streams of the granulator.
         )
-        comp = Compress(grn, thresh=-20, ratio=4, risetime=0.005, falltime=0.10, knee=0.5, mul=0.8)
+        if self.shared_buses:
+            # The voice is sent to the shared compressor and large reverb
+            grn.mul = gain
+            return {'out':grn, 'bus':'large', 'wet':0.4, 'instrument':grn, 'list_samples':sample_old, 'snd':snd, 'count':0, 'gain':gain, 'pending':None}
+        comp = Compress(grn, thresh=-20, ratio=4, risetime=0.005, falltime=0.10, knee=0.5, mul=gain)
         b = Freeverb(comp, size=[0.9,0.9], damp=0.5, bal=0.4)
-        return {'out':b, 'instrument':grn, 'list_samples':sample_old, 'snd':snd, 'count':0}
+        return {'out':b, 'instrument':grn, 'list_samples':sample_old, 'snd':snd, 'count':0, 'gain':gain, 'pending':None}
         
         
     def init_thresholds(self, normalized):
@@ -167,25 +409,32 @@ class Sound_Module:
         Granular synth initialization function n°2
 
         :param:
-        :return: Dictionary containing 1) the out module (reverb); 2) the instrument; 3) list of previously selected samples;
-                                       4) the table to read; 5) inner counter
+        :return: Dictionary containing 1) the out module (reverb, or the voice itself with shared buses); 2) the instrument;
+                                       3) list of previously selected samples; 4) the table to read; 5) inner counter; 6) the gain ramp;
+                                       7) the pending scheduled call; with shared buses, 8) the reverb bus and 9) the initial reverb balance
         """
-        snd_2 = SndTable()
         dir = random.choice([self.samples_dir_melody, self.samples_dir_voices])
-        sound = select_sample_by_key(dir, self.chords)
+        sound = self.catalog.select_by_key(dir, self.chords)
+        if sound is None:
+            sound = self.catalog.select(dir)
         path_3 = os.path.join(dir, sound)
         sample_old = deque(maxlen=5)
         sample_old.append(sound)
-        snd_2.setSound(path_3)
+        snd_2 = self.tables.get(path_3)
         end_2 = snd_2.getSize() - self.s.getSamplingRate() * 0.4
         env_2 = HarmTable()
         pos_2 = Phasor(snd_2.getRate()*.25, 0, snd_2.getSize())
         dns_2 = Randi(min=0, max=30, freq=0.01)
         pit_2 = Randi(min=0.99, max=1.01, freq=0.01)
         grn_2 = Granule(snd_2, env_2, dens=dns_2, pitch=pit_2, pos=pos_2, dur=1)
-        comp = Compress(grn_2, thresh=-20, ratio=4, risetime=0.005, falltime=0.10, knee=0.5, mul=0.08)
+        gain = SigTo(value=0, init=0)
+        if self.shared_buses:
+            # The voice is sent to the shared compressor and small reverb
+            grn_2.mul = gain
+            return {'out':grn_2, 'bus':'small', 'wet':0.1, 'instrument':grn_2, 'list_samples':sample_old, 'snd':snd_2, 'count':0, 'gain':gain, 'pending':None}
+        comp = Compress(grn_2, thresh=-20, ratio=4, risetime=0.005, falltime=0.10, knee=0.5, mul=gain)
         b_2 = Freeverb(comp, size=[0.5,0.5], damp=0.5, bal=0.1)
-        return {'out':b_2, 'instrument':grn_2, 'list_samples':sample_old, 'snd':snd_2, 'count':0}
+        return {'out':b_2, 'instrument':grn_2, 'list_samples':sample_old, 'snd':snd_2, 'count':0, 'gain':gain, 'pending':None}
         
         
     def init_cloud(self):
@@ -193,14 +442,16 @@ class Sound_Module:
         Cloud synth initialization function
 
         :param:
-        :return: Dictionary containing 1) the out module (reverb); 2) the instrument
+        :return: Dictionary containing 1) the out module (reverb); 2) the instrument; 3) the gain ramp; 4) the pending scheduled call;
+                                       5) the pitch choice and 6) its frequency, reused at each time-step
         """
-        pitches = pitch_quantizer(self.chords[0], onset_dict, 40, 80)
+        pitches = quantized_pitches(self.key_index, 0, 40, 80).tolist()
         mid = Choice(choice=pitches, freq=[10000, 10000])
         jit = Randi(min=0.993, max=1.007, freq=[10000, 10000])
         fr = MToF(mid, mul=jit)
         fd = Randi(min=0, max=0.01, freq=[10000, 10000])
-        a = SineLoop(freq=fr, feedback=fd, mul=0)
+        gain = SigTo(value=0, init=0)
+        a = SineLoop(freq=fr, feedback=fd, mul=gain)
         #d = Delay(a.mix(0), delay=[10,10], feedback=0.1)
         chor = Chorus(a, depth=[1,1], feedback=0.1, bal=0.1)
         #d = Disto(d, drive=.1, slope=.8)
@@ -209,7 +460,8 @@ class Sound_Module:
         eq = Biquad(c_1, freq=fr+100, q=1, type=1)
         c = Freeverb(eq, size=[0.9, 0.9], damp=0.7, bal=0.4)
         #c = Freeverb(c_2, size=[0.9, 0.9], damp=0.7, bal=0.4)
-        return {'out':c, 'instrument':a}
+        choice, pitch = self.init_pitch(pitches)
+        return {'out':c, 'instrument':a, 'gain':gain, 'pending':None, 'choice':choice, 'pitch':pitch}
         
         
     def init_second_cloud(self):
@@ -217,22 +469,36 @@ class Sound_Module:
         Cloud synth initialization function n°2
 
         :param:
-        :return: Dictionary containing 1) the out module (compressor); 2) the instrument
+        :return: Dictionary containing 1) the out module (compressor); 2) the instrument; 3) the gain ramp; 4) the pending scheduled call;
+                                       5) the pitch choice and 6) its frequency, reused at each time-step
         """
-        pitches_2mid = pitch_quantizer(self.chords[0], onset_dict, 40, 80)
+        pitches_2mid = quantized_pitches(self.key_index, 0, 40, 80).tolist()
         mid_2mid = Choice(choice=pitches_2mid, freq=[10, 10])
         jit_2mid = Randi(min=0.993, max=1.007, freq=[4, 4])
         fr_2mid = MToF(mid_2mid, mul=jit_2mid)
         fd_2mid = Randi(min=0, max=0.01, freq=[4, 4])
         sp_2mid = RandInt(max=20, freq=10000, add=0)
         amp_2mid = Sine(sp_2mid, mul=0.01, add=0)
-        a_2mid = SineLoop(freq=fr_2mid, feedback=fd_2mid)
+        gain = SigTo(value=0, init=0)
+        a_2mid = SineLoop(freq=fr_2mid, feedback=fd_2mid, mul=gain)
         d_2mid = Delay(a_2mid.mix(random.choice([0,1,2])), delay=[10,10], feedback=0.1)
         chor_2mid = Chorus(d_2mid, depth=[1,1], feedback=0.1, bal=0.1)
         c_1_2mid = Freeverb(a_2mid+d_2mid, size=[0.4, 0.4], damp=0.1, bal=0.3)
         c_2mid = Freeverb(c_1_2mid, size=[0.9, 0.9], damp=0.2, bal=0.3)
         comp = Compress(c_2mid, thresh=-20, ratio=4, risetime=0.005, falltime=0.10, knee=0.5, mul=0.01)
-        return {'out':comp, 'instrument':a_2mid}
+        choice, pitch = self.init_pitch(pitches_2mid)
+        return {'out':comp, 'instrument':a_2mid, 'gain':gain, 'pending':None, 'choice':choice, 'pitch':pitch}
+
+
+    def init_pitch(self, pitches):
+        """
+        Cloud pitch generator initialization function
+
+        :param pitches: Initial list of midi notes to choose from
+        :return: Tuple containing the random choice between the notes and its frequency
+        """
+        choice = Choice(choice=pitches, freq=[10, 10])
+        return choice, MToF(choice, mul=1)
 
 
     def init_bass(self):
@@ -240,39 +506,89 @@ class Sound_Module:
         Bass synth initialization function
 
         :param:
-        :return: Dictionary containing 1) the out module (reverb); 2) the instrument
+        :return: Dictionary containing 1) the out module (reverb); 2) the instrument; 3) the gain ramp; 4) the pending scheduled call
         """
-        syn = SineLoop(freq=110, feedback=.07, mul=0.1)
+        gain = SigTo(value=0, init=0)
+        syn = SineLoop(freq=110, feedback=.07, mul=gain)
         disto_bass = Disto(syn, drive=0.001, slope=.5)
         c_low = Freeverb(disto_bass, size=[0.5, 0.5], damp=0.7, bal=0.1)
-        return {'out':c_low, 'instrument':syn}
+        return {'out':c_low, 'instrument':syn, 'gain':gain, 'pending':None}
 
 
-    def init_instruments(self):
+    def init_buses(self):
         """
-        Instruments initialization function
+        Shared buses initialization function: granular voices are mixed to a dry output and two reverbs (large and small room),
+        compressed together, so that the cost of the effects does not grow with the number of voices
 
         :param:
         :return:
         """
+        self.mixer = Mixer(outs=len(BUS_OUTPUTS), chnls=2, time=0.05)
+        dry = Sig(self.mixer[BUS_OUTPUTS['dry']])
+        large = Freeverb(self.mixer[BUS_OUTPUTS['large']], size=[0.9,0.9], damp=0.5, bal=1)
+        small = Freeverb(self.mixer[BUS_OUTPUTS['small']], size=[0.5,0.5], damp=0.5, bal=1)
+        comp = Compress(dry+large+small, thresh=-20, ratio=4, risetime=0.005, falltime=0.10, knee=0.5)
+        self.buses = {'dry':dry, 'large':large, 'small':small, 'out':comp.out()}
+        return
+
+
+    def set_reverb(self, instrument, wet):
+        """
+        Reverb balance setting function
+
+        :param instrument: Name of the instrument to modify
+        :param wet: Balance between the dry and reverberated signals (1 is fully reverberated)
+        :return:
+        """
+        if self.instruments[instrument].get('bus') is None:
+            self.instruments[instrument]['out'].bal = wet
+        else:
+            # Same balance, as send levels to the dry output and to the reverb of the voice
+            self.mixer.setAmp(instrument, BUS_OUTPUTS['dry'], 1-wet)
+            self.mixer.setAmp(instrument, BUS_OUTPUTS[self.instruments[instrument]['bus']], wet)
+        return
+
+
+    def init_instruments(self, roster=None):
+        """
+        Instruments initialization function
+
+        :param roster: Optional dictionary mapping each instrument name to its kind, drawn at random if None
+        :return:
+        """
+        if roster is None:
+            roster = {}
+            # Creates the required number of granulars
+            for i in range(self.list_instruments[0]):
+                if random.random()>0.5:
+                    roster['grn_{}'.format(i)] = 'particule'
+                else:
+                    roster['grn_{}'.format(i)] = 'particule2'
+            # Always creates a bass
+            roster['bass'] = 'bass'
+
+            # Creates the required number of clouds
+            for i in range(self.list_instruments[1]):
+                if random.random()>0.2:
+                    roster['cloud_{}'.format(i)] = 'cloud'
+                else:
+                    roster['cloud_second_{}'.format(i)] = 'second_cloud'
+        # Keeps the kind of each instrument so that the roster can be saved in a score
+        self.roster = roster
+        # The instruments draw from their own seed, so that a replayed roster picks the same samples
+        self.reseed('instruments')
         # Creates the dictionary of instruments
         self.instruments = {}
-        
-        # Creates the required number of granulars
-        for i in range(self.list_instruments[0]):
-            if random.random()>0.5:
-                self.instruments['grn_{}'.format(i)] = self.init_particule()
-            else:
-                self.instruments['grn_{}'.format(i)] = self.init_particule2()
-        # Always creates a bass
-        self.instruments['bass'] = self.init_bass()
-        
-        # Creates the required number of clouds
-        for i in range(self.list_instruments[1]):
-            if random.random()>0.2:
-                self.instruments['cloud_{}'.format(i)] = self.init_cloud()
-            else:
-                self.instruments['cloud_second_{}'.format(i)] = self.init_second_cloud()
+        for name, kind in roster.items():
+            self.instruments[name] = getattr(self, 'init_'+kind)()
+            # Timer running the calls scheduled on the instrument, it is re-armed rather than allocated for each call
+            self.instruments[name]['timer'] = CallAfter(self.call_pending, time=1, arg=name).stop()
+            # Objects the instrument is built from, stopped with it so that a silent instrument costs no CPU
+            self.instruments[name]['chain'] = instrument_chain(self.instruments[name])
+            if self.instruments[name].get('bus') is not None:
+                # Routes the voice to the shared buses
+                self.mixer.addInput(name, self.instruments[name]['out'])
+                self.set_reverb(name, self.instruments[name]['wet'])
         return
         
         
@@ -288,53 +604,180 @@ class Sound_Module:
                 self.restart([keys], 0.1, self.TIME_REACT)
             else:
                 self.restart([keys], 0.3, self.TIME_REACT)
+        self.active = set(self.instruments)
         return
         
         
     def shut(self, instruments, duration):
         """
-        Instrument stopping function
+        Instrument stopping function, the fadeout runs in the audio engine and the call returns immediately
 
         :param instruments: List of instrument names to stop
-        :param duration: Time taken to shut one instrument down
+        :param duration: Time taken by one of the 100 steps of the fadeout
         :return:
         """
         for i in instruments:
-            # Calculates intermediate volume values (fadeout effect)
-            fadeout = self.fadeout(self.instruments[i]['instrument'].mul)
-            for value in fadeout:
-                # Modifies the mul parameter of the instrument
-                if 'grn' in i:
-                    self.instruments[i]['out'].input.mul = float(value)
-                else:
-                    self.instruments[i]['instrument'].mul = float(value)
-                time.sleep(duration)
-            # Stops the instruments once its volume is at zero
-            self.instruments[i]['out'].stop()
+            # Ramps the gain of the instrument down to zero
+            self.ramp(i, 0, duration)
+            # Stops the instrument once its volume is at zero
+            self.schedule(i, 100*duration, self.stop_instrument, i)
         return
         
         
     def restart(self, instruments, volume, duration):
         """
-        Instrument restarting function
+        Instrument restarting function, the fadein runs in the audio engine and the call returns immediately
 
         :param instruments: List of instrument names to start
         :param volume: Volume at which the instrument will be raised
-        :param duration: Time taken to restart an instrument
+        :param duration: Time taken by one of the 100 steps of the fadein
         :return:
         """
+        # With control tables the gain only scales the volume read by the audio engine
+        if self.timeline is not None:
+            volume = 1.
         for i in instruments:
-            # Calculates intermediate volume values (fadein effect)
-            fadein = self.fadein(volume)
-            # Starts the instrument
-            self.instruments[i]['out'].out()
-            # Modifies the mul parameter of the instrument
-            for value in fadein:
-                if 'grn' in i:
-                    self.instruments[i]['out'].input.mul = float(value)
+            # Cancels a pending stop or change
+            self.cancel(i)
+            # Starts the instrument, unless its group is not played
+            if self.rendered(i):
+                for obj in self.instruments[i]['chain']:
+                    obj.play()
+                # Voices of the shared buses are heard through them, the other instruments go to the speakers
+                if self.instruments[i].get('bus') is None:
+                    self.instruments[i]['out'].out()
                 else:
-                    self.instruments[i]['instrument'].mul = float(value)
-                time.sleep(duration)
+                    self.instruments[i]['out'].play()
+            # Ramps the gain of the instrument up to the volume
+            self.ramp(i, volume, duration)
+        return
+    
+    
+    def outputs(self):
+        """
+        Outputs function
+
+        :param:
+        :return: List of the pyo objects sent to the speakers by the instruments played (see rendered) and the shared buses
+        """
+        outputs = [self.instruments[name]['out'] for name in self.instruments
+                   if self.instruments[name].get('bus') is None and self.rendered(name)]
+        if self.shared_buses and (self.groups is None or 'granular' in self.groups):
+            outputs.append(self.buses['out'])
+        return outputs
+
+
+    def rendered(self, instrument):
+        """
+        Function telling whether an instrument is heard
+
+        :param instrument: Name of the instrument
+        :return: True if the group of the instrument is played by this sound module
+        """
+        return self.groups is None or INSTRUMENT_GROUPS[self.roster[instrument]] in self.groups
+
+
+    def ramp(self, instrument, value, duration):
+        """
+        Gain ramp function
+
+        :param instrument: Name of the instrument to modify
+        :param value: Volume value at which the ramp arrives
+        :param duration: Time taken by one of the 100 steps of the ramp
+        :return:
+        """
+        gain = self.instruments[instrument]['gain']
+        gain.time = 100*duration
+        gain.value = float(value)
+        return
+        
+        
+    def schedule(self, instrument, delay, function, arg):
+        """
+        Delayed call function, replacing any call pending on the instrument
+
+        :param instrument: Name of the instrument concerned
+        :param delay: Time, in seconds, before the call
+        :param function: Function to call
+        :param arg: Argument of the function
+        :return:
+        """
+        self.instruments[instrument]['pending'] = (function, arg)
+        # Restarts the countdown of the instrument's timer
+        self.instruments[instrument]['timer'].setTime(delay)
+        self.instruments[instrument]['timer'].play()
+        return
+        
+        
+    def call_pending(self, instrument):
+        """
+        Pending call running function, called by the timer of the instrument
+
+        :param instrument: Name of the instrument concerned
+        :return:
+        """
+        if self.instruments[instrument]['pending'] is not None:
+            function, arg = self.instruments[instrument]['pending']
+            self.instruments[instrument]['pending'] = None
+            function(arg)
+        return
+        
+        
+    def cancel(self, instrument):
+        """
+        Pending call cancelling function
+
+        :param instrument: Name of the instrument concerned
+        :return:
+        """
+        self.instruments[instrument]['timer'].stop()
+        self.instruments[instrument]['pending'] = None
+        return
+        
+        
+    def stop_instrument(self, instrument):
+        """
+        Instrument output stopping function, called once its fadeout is over
+
+        :param instrument: Name of the instrument to stop
+        :return:
+        """
+        for obj in self.instruments[instrument]['chain']:
+            obj.stop()
+        return
+        
+        
+    def fade_change(self, instrument, duration_out, volume, duration_in, function, arg):
+        """
+        Fadeout, change and fadein function, none of the steps blocks the caller
+
+        :param instrument: Name of the instrument to modify
+        :param duration_out: Time taken by one of the 100 steps of the fadeout
+        :param volume: Volume at which the instrument will be raised after the change
+        :param duration_in: Time taken by one of the 100 steps of the fadein
+        :param function: Function applying the change once the instrument is silent
+        :param arg: Argument of the function
+        :return:
+        """
+        self.ramp(instrument, 0, duration_out)
+        self.schedule(instrument, 100*duration_out, self.apply_change, (instrument, volume, duration_in, function, arg))
+        return
+        
+        
+    def apply_change(self, change):
+        """
+        Change applying function, called once the fadeout of fade_change is over
+
+        :param change: Tuple containing the instrument name, the volume and fadein step duration, the function and its argument
+        :return:
+        """
+        instrument, volume, duration_in, function, arg = change
+        function(arg)
+        if instrument in self.active:
+            self.ramp(instrument, volume, duration_in)
+        else:
+            # The change replaced the pending stop of a silent instrument (e.g. the bass in update_cloud), it stops now
+            self.stop_instrument(instrument)
         return
     
     
@@ -364,160 +807,191 @@ class Sound_Module:
         return values
 
 
-    def fade_other(self, start, end):
-        """
-        Fadeother calculation function
-
-        :param start: Volume value from which the fade starts
-        :param end: Volume value at which the fade arrives
-        :return values: List of 100 intermediate, equally spaced volume values going from strat to end
-        """
-        values = []
-        step = np.abs(start-end)/100
-        if start > end:
-            for i in range(100):
-                values.append(start-i*step)
-            return values
-        else:
-            for i in range(100):
-                values.append(start+i*step)
-            return values
-    
-    
     def change_volume(self, start, end, instrument, duration):
         """
-        Volume change function
+        Volume change function, the ramp runs in the audio engine and the call returns immediately
 
-        :param start: Volume value from which the fade starts
+        :param start: Volume value from which the fade starts (the ramp starts from the current volume)
         :param end: Volume value at which the fade arrives
         :param instrument: Name of the instrument to modify
-        :param duration: Duration taken to change the volume
+        :param duration: Time taken by one of the 100 steps of the fade
         :return:
         """
-        values = []
-        # Calculates intermediate volume values
-        values = self.fade_other(start, end)
-        for value in values:
-            # Changes the volume value
-            if 'grn' in instrument:
-                self.instruments[instrument]['out'].input.mul = float(value)
-            else:
-                self.instruments[instrument]['instrument'].mul = float(value)
-            time.sleep(duration)
+        self.ramp(instrument, end, duration)
         return
         
         
-    def change_effect(self, start, end, effect, duration):
-        """
-        Effect change function
-
-        :param start: Effect value from which the fade starts
-        :param end: Effect value at which the fade arrives
-        :param effect: Name of the effect to modify
-        :param duration: Duration taken to change the effect
-        :return:
-        """
-        values = []
-        values = self.fade_other(start, end)
-        for value in values:
-            effect = float(value)
-            time.sleep(duration)
-        return
-    
-        
-    def build_conductor(self):
+    def build_conductor(self, size):
         """
-        Conductor Assembling function
+        Conductor assembling generator, each window is built from the state at the end of the previous one
 
-        :param:
-        :return array: Array of size nb_instruments*nb_timesteps containing volume values for each instrument
-        """
-        # Initializes the array
-        array = np.zeros((self.nb_instruments, len(self.list_blocks)))+np.round(random.choice(pdf(0, .1)),2)
-        # For each entropy value
-        for index in range(len(self.list_blocks)-1):
-            entropy = self.list_blocks[index]
-            # For each threshold value
-            for i in range(len(self.thresholds)-1):
-                # If entropy in an interval, number of instruments on that timestep = the index of that interval
-                if entropy>self.thresholds[i] and entropy<self.thresholds[i+1]:
-                    array[:,index+1] = self.build_next_step(array[:,index], i+1, index+1)
-            if entropy>self.thresholds[-1]:
-                array[:,index+1] = self.build_next_step(array[:,index], len(self.thresholds), index+1)
-        return array
+        :param size: Number of time-steps of each window
+        :return: Yields arrays of size nb_instruments*size (the last one can be shorter) containing volume values for each instrument
+        """
+        # Initial values of every instrument
+        start = np.zeros(self.nb_instruments)+np.round(random.choice(pdf(0, .1)),2)
+        current = list(start)
+        previous = np.sum(start>0)
+        entropies = np.asarray(self.list_blocks, dtype=float)
+        thresholds = np.asarray(self.thresholds, dtype=float)
+        for first in range(0, len(self.list_blocks), size):
+            last = min(first+size, len(self.list_blocks))
+            # Each time-step is built from the entropy value of the previous one, the first one keeps the initial values
+            steps = np.arange(max(first, 1), last)
+            entropy = entropies[steps-1]
+            # Number of instruments playing: the index of the threshold interval the entropy falls in
+            total_on = np.digitize(entropy, thresholds, right=True)
+            # Values equal to a threshold or below the first one fall in no interval, the time-step keeps its initial values
+            assigned = (entropy>thresholds[0]) & ~np.isin(entropy, thresholds)
+            counts = np.where(assigned, total_on, np.sum(start>0))
+            # Time-steps at which the set of instruments playing changes
+            events = np.flatnonzero(~assigned | (counts != np.concatenate([[previous], counts[:-1]])))
+            # Only the events are built one after the other, on small lists of instrument indices
+            states = [current]
+            for index in events:
+                if not assigned[index]:
+                    current = list(start)
+                else:
+                    current = list(current)
+                    current_on = [j for j in range(self.nb_instruments) if current[j] > 0]
+                    needed = int(total_on[index])-len(current_on)
+                    # Turns on randomly chosen instruments among those that are off, at volume .4
+                    if needed > 0:
+                        current_off = [j for j in range(self.nb_instruments) if current[j] == 0]
+                        for j in random.sample(current_off, needed):
+                            current[j] = .4
+                    # Shuts down randomly chosen instruments among the ones playing
+                    else:
+                        for j in random.sample(current_on, -needed):
+                            current[j] = 0.
+                states.append(current)
+            if len(counts) > 0:
+                previous = counts[-1]
+            # Every other time-step keeps the state of the last event
+            last_event = np.zeros(last-first, dtype=int)
+            last_event[steps[events]-first] = np.arange(1, len(events)+1)
+            last_event = np.maximum.accumulate(last_event)
+            yield np.array(states, dtype=float).T[:, last_event]
      
     
-    def build_next_step(self, current_step, total_on, index):
-        """
-        Conductor Step Building function
-
-        :param current_step: The volume values of all instruments at a certain time step
-        :param total_on: The number of instruments playing needed
-        :param index: Current index in the conductor
-        :return answer: Array of size nb_instruments*1 containing the volume for the next time step based on the previous one and the current entropy value
-        """
-        # Finds the instruments currently playing
-        current_on = list(np.where(current_step>0)[0])
-        # Finds the instruments not playing
-        current_off = list(np.where(current_step==0.)[0])
-        # If we need to turn on more instruments
-        if total_on > len(current_on):
-            # We find how many
-            needed = total_on - len(current_on)
-            # We randomly choose among those that are off
-            choices = random.sample(current_off, needed)
-            answer = current_step.copy()
-            # We set their volume to .4
-            answer[choices] =.4
-            return answer
-        # If enough instruments are already playing
-        elif total_on == len(current_on):
-            answer = current_step.copy()
-            # We return a copy of the current step
-            return answer
-        # If we need to shut instruments down
-        elif total_on < len(current_on):
-            # We count how many
-            needed = len(current_on) - total_on
-            # We randomly choose among the ones playing
-            choices = random.sample(current_on, needed)
-            answer = current_step.copy()
-            # We set their volume to 0
-            answer[choices] = 0
-            return answer
-            
-            
-    def post_process_conductor(self, array):
+    def post_process_conductor(self, array, first=0, j_cloud=None):
         """
         Conductor post-processing function
 
-        :param array: Conductor array before post-processing step
+        :param array: Conductor array (or window of it) before post-processing step
+        :param first: Time-step of the first column of the array
+        :param j_cloud: Index of the cloud kept quietly playing when at most one instrument is on (see init_conductors)
         :return array: Post-processed conductor array
         """
-        j_cloud = 100
-        for i in range(len(array)):
-            for j in range(2, len(array[i])):
-                new_value = array[i,j]
-                # Applies several post-processing operations (volume limiter etc ...)
-                if list(self.instruments.keys())[i]=='bass' and new_value>0:
-                    new_value = .2
-                elif 'cloud_second' in list(self.instruments.keys())[i] and new_value>0:
-                    new_value = .4
-                elif 'cloud' in list(self.instruments.keys())[i] and new_value>0:
-                    j_cloud = i
-                    new_value = .2
-                elif new_value>.6:
-                    new_value = .4
-                elif new_value>0:
-                    new_value = random.choice([.1, .2, .3, .4])
-                array[i,j] = new_value
-        if j_cloud != 100:
-            for i in range(len(array[0,:])):
-                if len(np.where(array[:,i]>0)[0])==1 or len(np.where(array[:,i]>0)[0])==0:
-                    array[j_cloud,i] = .1
+        names = list(self.instruments.keys())
+        is_bass = np.array([name=='bass' for name in names])[:, None]
+        is_second = np.array(['cloud_second' in name for name in names])[:, None]
+        is_cloud = np.array(['cloud' in name for name in names])[:, None] & ~is_second
+        # Applies several post-processing operations (volume limiter etc ...), from the third time-step on
+        values = array[:, max(2-first, 0):]
+        playing = values>0
+        # Drawn time-step by time-step, so that the volumes do not depend on the size of the window
+        random_volumes = np.random.choice([.1, .2, .3, .4], size=values.shape[::-1]).T
+        new_values = np.where(playing, random_volumes, values)
+        new_values = np.where(values>.6, .4, new_values)
+        new_values = np.where(is_cloud & playing, .2, new_values)
+        new_values = np.where(is_second & playing, .4, new_values)
+        new_values = np.where(is_bass & playing, .2, new_values)
+        array[:, max(2-first, 0):] = new_values
+        # The cloud is kept quietly playing when at most one instrument is on
+        if j_cloud is not None:
+            array[j_cloud, np.sum(array>0, axis=0)<=1] = .1
         return array
                 
                 
+    def init_conductors(self, lookahead=None):
+        """
+        Conductors initialization function: the conductor, melodic conductor and granular conductor are built window by
+        window, the first window before the performance and the next ones while it plays (see generate)
+
+        :param lookahead: Number of time-steps of each window, everything is built at once if None
+        :return:
+        """
+        self.lookahead = lookahead if lookahead else len(self.list_blocks)
+        print('Conductor initialization ...')
+        self.init_conductor()
+        print('Melodic conductor initialization ...')
+        self.init_melodic_conductor()
+        print('Granular conductor initialization ...')
+        self.init_grn_conductor()
+        # Each conductor draws from its own random state, so that building it does not depend on when it happens, nor
+        # on the size of the windows
+        self.conductors_random = {}
+        for stage in CONDUCTOR_STAGES:
+            self.reseed(stage)
+            self.conductors_random[stage] = (random.getstate(), np.random.get_state())
+        # The last cloud (besides the second clouds) is the one kept quietly playing, chosen once for every window
+        clouds = [j for j, name in enumerate(self.instruments) if 'cloud' in name and 'cloud_second' not in name]
+        self.j_cloud = clouds[-1] if len(clouds) > 0 else None
+        # Number of time-steps built
+        self.generated = 0
+        self.generate(1)
+        return
+
+
+    def reseed(self, stage):
+        """
+        Random generators seeding function: each stage draws from a seed derived from the seed of the sound module, so
+        that a replayed score, which skips the draws of the conductors, makes the same draws as the original performance
+
+        :param stage: Name of the stage (see SEED_STAGES)
+        :return:
+        """
+        seed = int(np.random.SeedSequence([self.seed, SEED_STAGES[stage]]).generate_state(1)[0])
+        random.seed(seed)
+        np.random.seed(seed)
+        return
+
+
+    def generate(self, stop):
+        """
+        Conductors generating function: builds the next windows of the three conductors until the time-step stop is built
+
+        :param stop: Time-step before which every time-step must be built, all of them for len(list_blocks)
+        :return:
+        """
+        if self.generated >= min(stop, len(self.list_blocks)):
+            return
+        performance_random = (random.getstate(), np.random.get_state())
+        while self.generated < min(stop, len(self.list_blocks)):
+            first = self.generated
+            array = self.draw('conductor', next, self.conductor_windows)
+            array = self.draw('post_process', self.post_process_conductor, array, first, self.j_cloud)
+            last = first+array.shape[1]
+            for j, name in enumerate(self.conductor):
+                self.conductor[name][first:last] = array[j]
+            self.melody_conductor[first:last] = self.draw('melodic_conductor', next, self.melody_windows)
+            window = self.draw('grn_conductor', next, self.grn_windows)
+            for name in self.grn_conductor:
+                for field in window:
+                    self.grn_conductor[name][field].extend(window[field])
+            self.generated = last
+        random.setstate(performance_random[0])
+        np.random.set_state(performance_random[1])
+        return
+
+
+    def draw(self, stage, function, *args):
+        """
+        Conductor drawing function: calls the function with the random state of the stage, then saves it for the next window
+
+        :param stage: Name of the conductor stage (see CONDUCTOR_STAGES)
+        :param function: Function drawing from the random generators
+        :param args: Arguments of the function
+        :return: The value returned by the function
+        """
+        random.setstate(self.conductors_random[stage][0])
+        np.random.set_state(self.conductors_random[stage][1])
+        value = function(*args)
+        self.conductors_random[stage] = (random.getstate(), np.random.get_state())
+        return value
+
+
     def init_conductor(self):
         """
         Conductor initialization function
@@ -525,11 +999,11 @@ class Sound_Module:
         :param:
         :return:
         """
-        # Converts the conductor array to a dictionary using instrument names as keys
-        array = self.post_process_conductor(self.build_conductor())
+        # The conductor is a dictionary of arrays using instrument names as keys, filled as the windows are built
         self.conductor = {}
-        for i in range(len(array)):
-            self.conductor[list(self.instruments)[i]] = array[i,:]
+        for name in self.instruments:
+            self.conductor[name] = np.zeros(len(self.list_blocks))
+        self.conductor_windows = self.build_conductor(self.lookahead)
         return
         
         
@@ -540,16 +1014,40 @@ class Sound_Module:
         :param i: current time-step
         :return:
         """
+        # Instruments the conductor plans to play
+        planned = set(instrument for instrument in self.conductor if self.conductor[instrument][i] > 0)
+        # The governor may leave some of them out to stay within the CPU budget
+        if self.governor is not None:
+            playing = self.governor.allowed(planned, i, self)
+        else:
+            playing = planned
         for instrument in list(self.conductor.keys()):
             # For each instrument
             # Turns it off if needed
-            if self.conductor[instrument][i] == 0 and self.conductor[instrument][i-1] > 0:
+            if instrument in self.active and instrument not in playing:
                 self.shut([instrument], self.TIME_REACT)
             # Restarts it if needed
-            elif self.conductor[instrument][i] > 0 and self.conductor[instrument][i-1] == 0 :
+            elif instrument not in self.active and instrument in playing:
                 self.restart([instrument], float(self.conductor[instrument][i]), self.TIME_REACT)
+        self.active = playing
         return
         
+        
+    def volume(self, instrument, i):
+        """
+        Instrument volume function
+
+        :param instrument: Name of the instrument
+        :param i: current time-step
+        :return: Volume planned by the conductor if the instrument is playing (1 with control tables, the gain then scaling
+                 the volume read by the audio engine), 0 otherwise
+        """
+        if instrument in self.active:
+            if self.timeline is not None:
+                return 1.
+            return float(self.conductor[instrument][i])
+        return 0.
+        
     
     def print_volumes(self):
         """
@@ -561,7 +1059,7 @@ class Sound_Module:
         # Prints the volume of every instrument
         for i in list(self.instruments.keys()):
             print('INSTRUMENT :', i)
-            print('VOLUME :',self.instruments[i]['instrument'].mul)
+            print('VOLUME :',self.instruments[i]['gain'].get())
         return
         
         
@@ -572,38 +1070,44 @@ class Sound_Module:
         :param:
         :return:
         """
-        self.melody_conductor = {}
-        # Saves the current key the performance is in
-        self.melody_conductor['key'] = [self.current_key]
-        # Saves the list of possible chords from that key
-        self.melody_conductor['chords'] = [self.chords]
-        # Iterates over all the entropy values
-        for i in range(1, len(self.list_blocks)):
-            # If there is a high gap between two consecutive values (>.4)
-            if np.abs(self.list_blocks[i]-self.list_blocks[i-1])>.4:
-                # Chooses a new key
-                next_key = random_walk(tuple(self.current_key))
-                # Builds list of allowed chords
-                next_chords =  build_chords(build_key(tuple(next_key)))
-                self.melody_conductor['key'].append(next_key)
-                self.melody_conductor['chords'].append(next_chords)
-            # Otherwise, stays in the same key
-            else:
-                self.melody_conductor['key'].append(self.current_key)
-                self.melody_conductor['chords'].append(self.chords)
+        # The melodic conductor is the index (in KEYS) of the key the performance is in at each time-step
+        self.melody_conductor = np.full(len(self.list_blocks), self.key_index, dtype=np.int8)
+        self.melody_windows = self.build_melodic_conductor(self.key_index, self.lookahead)
         return
+
+
+    def build_melodic_conductor(self, key_index, size):
+        """
+        Melodic conductor assembling generator
+
+        :param key_index: Index (in KEYS) of the initial key
+        :param size: Number of time-steps of each window
+        :return: Yields arrays (the last one can be shorter) containing the index of the key at each time-step
+        """
+        entropies = np.asarray(self.list_blocks, dtype=float)
+        for first in range(0, len(entropies), size):
+            last = min(first+size, len(entropies))
+            keys = np.full(last-first, key_index, dtype=np.int8)
+            # Time-steps following a high gap between two consecutive values (>.4)
+            origin = max(first-1, 0)
+            changes = np.flatnonzero(np.abs(np.diff(entropies[origin:last]))>.4)+origin+1-first
+            # Chooses a new key among the neighbours of the initial key, otherwise stays in the same key
+            choices = np.random.randint(0, KEY_NEIGHBOURS.shape[1], len(changes))
+            keys[changes] = KEY_NEIGHBOURS[key_index, choices]
+            yield keys
         
         
     def read_melodic_conductor(self, i):
         """
-        Melodic conductor initialization function
+        Melodic conductor reading function
 
         :param i: current time-step
         :return:
         """
-        # Reads content from the melodic conductor at a given time-step
-        self.current_key = self.melody_conductor['key'][i]
-        self.chords = self.melody_conductor['chords'][i]
+        # Reads the key from the melodic conductor at a given time-step, its chords come from the lookup table
+        self.key_index = int(self.melody_conductor[i])
+        self.current_key = KEYS[self.key_index]
+        self.chords = KEY_CHORDS[self.key_index]
         return
     
     
@@ -615,32 +1119,58 @@ class Sound_Module:
         :return:
         """
         # Chooses a random chord from the list of chords allowed
-        chord = random_chord(self.chords)
-        # Quantizes the pitch
-        final_pitches = pitch_quantizer(chord, onset_dict, self.MIDDLE-self.STD-int(2*self.list_blocks[i]*self.STD), self.MIDDLE+self.STD+int(4*self.list_blocks[i]*self.STD))
+        chord = random.randrange(len(self.chords))
+        # Quantizes the pitch, reading the pitches of the chord in the lookup table
+        inf = self.MIDDLE-self.STD-int(2*self.list_blocks[i]*self.STD)
+        final_pitches = quantized_pitches(self.key_index, chord, inf, self.MIDDLE+self.STD+int(4*self.list_blocks[i]*self.STD)).tolist()
         # Sets a pitch for the bass
-        pitch_bass = random.choice(chord)
+        pitch_bass = random.choice(self.chords[chord])
         # Quantizes the bass pitch
-        bass = pitch_quantizer([pitch_bass], onset_dict, 48, 64)
-        # Turns off the bass
-        self.shut(['bass'], 0.005)
-        # Changes its fequency
-        self.instruments['bass']['instrument'].freq = bass[0]
-        # Starts it again with the new frequency
-        self.restart(['bass'], float(self.conductor['bass'][i]), 0.005)
+        bass = lowest_pitch(pitch_bass, 48)
+        # Turns down the bass, changes its frequency and raises it again
+        self.fade_change('bass', 0.005, self.volume('bass', i), 0.005, self.change_bass, bass)
         # For all the melodic instruments
         for instrument in list(self.instruments.keys()):
-            if 'cloud' in instrument and self.conductor[instrument][i]>0:
+            # Keeps the previous notes when no note of the chord falls in the range
+            if 'cloud' in instrument and self.volume(instrument, i)>0 and len(final_pitches)>0:
                 if 'second' in instrument:
-                    final_pitches = [final_pitches[0]]
-                # Random choice between the notes of a given chord
-                mid = Choice(choice=final_pitches, freq=[10, 10])
-                fr = MToF(mid, mul=1)
+                    # Lowest pitch of the root of the chord
+                    final_pitches = [lowest_pitch(self.chords[chord][0], inf)]
+                # Random choice between the notes of a given chord, the same generator is updated at each time-step
+                self.instruments[instrument]['choice'].setChoice(final_pitches)
                 # Sets the frequency of the instrument to that note
-                self.instruments[instrument]['instrument'].freq = fr
+                if self.instruments[instrument]['instrument'].freq is not self.instruments[instrument]['pitch']:
+                    self.instruments[instrument]['instrument'].freq = self.instruments[instrument]['pitch']
         return
         
                 
+    def change_bass(self, freq):
+        """
+        Bass frequency changing function
+
+        :param freq: New frequency of the bass
+        :return:
+        """
+        self.instruments['bass']['instrument'].freq = freq
+        return
+        
+        
+    def change_sample(self, change):
+        """
+        Granular sample changing function, called by the timer of the instrument: the table is already decoded,
+        only the table read by the instrument is swapped
+
+        :param change: Tuple containing the name of the instrument, the name of the new sample and its table
+        :return:
+        """
+        instrument, sample, snd = change
+        self.instruments[instrument]['snd'] = snd
+        self.instruments[instrument]['instrument'].table = snd
+        # Saves the name of the sample for later, once it is actually played
+        self.instruments[instrument]['list_samples'].append(sample)
+        return
+        
+        
     def update_samples(self, instrument, i, dir, LIMIT):
         """
         Granular samples updating function
@@ -654,64 +1184,100 @@ class Sound_Module:
         # Find current sample of the instrument considered
         sample = self.instruments[instrument]['list_samples'][-1]
         # If instrument currently playing
-        if self.conductor[instrument][i]>0:
+        if self.volume(instrument, i)>0:
             if dir in [self.samples_dir_voices, self.samples_dir_aggressive, self.samples_dir_beat]:
                 # If the sample has not changed for a while
-                if self.instruments[instrument]['count']>LIMIT:
-                    # Looks for a sample that has not been selected lately
-                    while (sample in self.instruments[instrument]['list_samples']):
-                        sample = select_sample_by_key(dir, self.chords)
-                        while(sample == None):
-                            sample = select_sample_by_key(dir, self.chords)
-                    if sample != None:
-                        path = os.path.join(dir,sample)
-                        # Shuts the instrument down to replace the sample
-                        self.shut([instrument], 0.01)
-                        self.instruments[instrument]['snd'].setSound(path)
-                        self.instruments[instrument]['instrument'].table = self.instruments[instrument]['snd']
-                        # Restarts the instrument with the new sample
-                        self.restart([instrument], float(self.conductor[instrument][i]), self.TIME_REACT)
-                    if sample.endswith('.wav'):
-                        # Saves the name of the sample for later
-                        self.instruments[instrument]['list_samples'].append(sample)
-                        self.instruments[instrument]['count'] = 0
-                    return
-                else:
-                    self.instruments[instrument]['count'] += 1
-                    return
+                change = self.instruments[instrument]['count']>LIMIT
             else:
                 # If the sample is not in key anymore, or has not changed for a while
-                if (not check_still_in_key(sample, self.chords)) or self.instruments[instrument]['count']>LIMIT:
-                    while (sample in self.instruments[instrument]['list_samples']):
-                        sample = select_sample_by_key(dir, self.chords)
-                        while(sample == None):
-                            sample = select_sample_by_key(dir, self.chords)
-                    if sample != None:
-                        path = os.path.join(dir,sample)
-                        self.shut([instrument], 0.01)
-                        self.instruments[instrument]['snd'].setSound(path)
-                        self.instruments[instrument]['instrument'].table = self.instruments[instrument]['snd']
-                        self.restart([instrument], float(self.conductor[instrument][i]), self.TIME_REACT)
-                    if sample.endswith('.wav'):
-                        self.instruments[instrument]['list_samples'].append(sample)
-                        self.instruments[instrument]['count'] = 0
-                    return
-                else:
-                    self.instruments[instrument]['count'] += 1
-                    return
+                change = (not check_still_in_key(sample, self.chords)) or self.instruments[instrument]['count']>LIMIT
+            if change:
+                # Looks for a sample in key that has not been selected lately
+                sample = self.catalog.select_by_key(dir, self.chords, exclude=self.instruments[instrument]['list_samples'])
+                # If there is none, keeps the current sample and tries again at the next time-step
+                if sample != None:
+                    path = os.path.join(dir,sample)
+                    # Decodes the sample now, not in the audio thread where the change is applied
+                    snd = self.tables.get(path)
+                    # Turns the instrument down, replaces the sample and raises it again (a stop replacing the change
+                    # before it is applied keeps the current sample)
+                    self.fade_change(instrument, 0.01, self.volume(instrument, i), self.TIME_REACT, self.change_sample, (instrument, sample, snd))
+                    self.instruments[instrument]['count'] = 0
+                return
+            else:
+                self.instruments[instrument]['count'] += 1
+                return
             
             
-    def update_time(self, i):
+    def read_score(self, score):
         """
-        Time updating function
+        Score reading function: restores the conductors and wait times instead of building them
+
+        :param score: Dictionary containing the arrays of the score (see score.load_score)
+        :return:
+        """
+        self.thresholds = list(score['thresholds'])
+        self.conductor = {}
+        for i, name in enumerate(score['names']):
+            self.conductor[name] = score['conductor'][i]
+        self.melody_conductor = score['keys'].astype(np.int8)
+        dirs = [self.samples_dir_melody, self.samples_dir_voices, self.samples_dir_beat, self.samples_dir_aggressive]
+        self.grn_conductor = {}
+        for i, name in enumerate(score['grn_names']):
+            self.grn_conductor[name] = {}
+            self.grn_conductor[name]['samples_file'] = [dirs[index] for index in score['grn_dirs'][i]]
+            self.grn_conductor[name]['duration'] = score['grn_duration'][i]
+            self.grn_conductor[name]['density'] = score['grn_density'][i]
+            self.grn_conductor[name]['reverb_wet'] = score['grn_reverb_wet'][i]
+        self.wait_times = [float(time) for time in score['wait_times']]
+        # Every time-step is already built
+        self.lookahead = len(self.list_blocks)
+        self.generated = len(self.list_blocks)
+        return
         
-        :param i: Current time-step
+        
+    def init_automation(self):
+        """
+        Control tables initialization function: the volumes of the conductor and the parameters of the granular conductor
+        are written to tables read on a timeline shared by all the instruments, so that they change in the audio engine
+
+        :param:
+        :return:
+        """
+        # The tables cover the whole performance
+        self.generate(len(self.list_blocks))
+        # Leaves time for the last fades to end, as render does
+        self.timeline = Control_Timeline(self.wait_times, tail=100*self.TIME_REACT)
+        for name in self.instruments:
+            # Volume of the instrument while it plays, held while it is silent so that it fades out from it
+            level = self.timeline.track(forward_fill(self.conductor[name]))
+            self.instruments[name]['level'] = Port(level, risetime=100*self.TIME_REACT, falltime=100*self.TIME_REACT)
+            # The gain ramp, driven by read_conductor and the fades, scales the level
+            self.instruments[name]['gain'].mul = self.instruments[name]['level']
+        for name in self.grn_conductor:
+            # Same values as read_grn_conductor, updated every GRN_UPDATE_PERIOD time-steps
+            self.instruments[name]['instrument'].dur = self.timeline.track(self.grn_conductor[name]['duration'], GRN_UPDATE_PERIOD)
+            self.instruments[name]['instrument'].dens = self.timeline.track(self.grn_conductor[name]['density'], GRN_UPDATE_PERIOD)
+            if self.instruments[name].get('bus') is None:
+                self.instruments[name]['out'].bal = self.timeline.track(self.grn_conductor[name]['reverb_wet'], GRN_UPDATE_PERIOD)
+        for name in self.instruments:
+            # The readers are stopped with the instrument, the timeline keeps running
+            self.instruments[name]['chain'] = instrument_chain(self.instruments[name], [self.timeline.phasor])
+        return
+
+
+    def init_wait_times(self):
+        """
+        Wait times initialization function
+
+        :param:
         :return:
         """
-        # Randomly assigns a duration for this time-step
-        time = random.choice([self.list_blocks[i]*10, 2+(1-self.list_blocks[i])*10])
-        print('Wait time = ', time, 's')
-        return time
+        # Randomly assigns a duration for each time-step
+        self.wait_times = []
+        for entropy in self.list_blocks:
+            self.wait_times.append(float(random.choice([entropy*10, 2+(1-entropy)*10])))
+        return
         
         
     def pick_from_list(self, choices, probabilities):
@@ -742,32 +1308,49 @@ class Sound_Module:
                 self.grn_conductor[i]['duration'] = []
                 self.grn_conductor[i]['density'] = []
                 self.grn_conductor[i]['reverb_wet'] = []
-                
+        self.grn_windows = self.build_grn_conductor(self.lookahead)
+        return
+
+
+    def build_grn_conductor(self, size):
+        """
+        Granular conductor assembling generator
+
+        :param size: Number of time-steps of each window
+        :return: Yields dictionaries containing, for the time-steps of each window, the lists of samples directories, grain
+                 durations, grain densities and reverb balances shared by the granular synths
+        """
         # Defines the samples directories available
         choices = [self.samples_dir_melody, self.samples_dir_voices, self.samples_dir_beat, self.samples_dir_aggressive]
-        # For each time-step
-        size = len(self.thresholds)
-        for entropy in self.list_blocks:
-            # Finds the threshold interval for the current time-step
-            for i in range(len(self.thresholds)-1, -1, -1):
-                if entropy>self.thresholds[i]:
-                    # Defines the probabilities to choose each samples directory
-                    probabilities = [(size-i)/size, (size-i)/size, i/size, i/size]
-                    # Normalizes the probability distribution
-                    probabilities /= np.sum(probabilities)
-                    # Random weighted choice from the list
-                    choice = self.pick_from_list(choices, probabilities)
-                    for grn in list(self.grn_conductor.keys()):
-                        # Replaces samples directory with the newly selected one
-                        self.grn_conductor[grn]['samples_file'].append(choice)
-                        # Grain duration modification
-                        self.grn_conductor[grn]['duration'].append(2-entropy/2)
-                        # Grain density modification
-                        self.grn_conductor[grn]['density'].append(150-(10+entropy)*entropy)
-                        # Reverb modification
-                        self.grn_conductor[grn]['reverb_wet'].append(1-entropy)
-                    break
-        return
+        size_thresholds = len(self.thresholds)
+        for first in range(0, len(self.list_blocks), size):
+            window = {'samples_file':[], 'duration':[], 'density':[], 'reverb_wet':[]}
+            # For each time-step
+            for index in range(first, min(first+size, len(self.list_blocks))):
+                entropy = self.list_blocks[index]
+                # Finds the threshold interval for the current time-step
+                for i in range(len(self.thresholds)-1, -1, -1):
+                    # Values below the first threshold fall in the first interval, so that every time-step has an entry
+                    if entropy>self.thresholds[i] or i == 0:
+                        # Defines the probabilities to choose each samples directory
+                        probabilities = [(size_thresholds-i)/size_thresholds, (size_thresholds-i)/size_thresholds, i/size_thresholds, i/size_thresholds]
+                        # Normalizes the probability distribution
+                        probabilities /= np.sum(probabilities)
+                        # Random weighted choice from the list
+                        choice = self.pick_from_list(choices, probabilities)
+                        density = 150-(10+entropy)*entropy
+                        reverb_wet = 1-entropy
+                        if self.features is not None:
+                            # Denser grains on edgy blocks, drier reverb on blocks rich in high frequencies
+                            density += 50*self.features['edges'][index]
+                            reverb_wet *= 1-self.features['spectral'][index]
+                        # Samples directory, grain duration, grain density and reverb of the time-step
+                        window['samples_file'].append(choice)
+                        window['duration'].append(2-entropy/2)
+                        window['density'].append(density)
+                        window['reverb_wet'].append(reverb_wet)
+                        break
+            yield window
                     
                     
     def read_grn_conductor(self,i):
@@ -781,8 +1364,11 @@ class Sound_Module:
         for name in list(self.grn_conductor.keys()):
             # Updates the samples directory
             self.update_samples(name, i, self.grn_conductor[name]['samples_file'][i], random.choice([2, 3, 4, 5, 6]))
-            # Updates the parameters
-            if i%5==0 and self.conductor[name][i]>0:
-                self.instruments[name]['instrument'].dur = float(self.grn_conductor[name]['duration'][i])
-                self.instruments[name]['instrument'].dens = float(self.grn_conductor[name]['density'][i])
-                self.instruments[name]['out'].bal = float(self.grn_conductor[name]['reverb_wet'][i])
+            # Updates the parameters, unless they are read from the control tables
+            if i%GRN_UPDATE_PERIOD==0 and self.volume(name, i)>0:
+                if self.timeline is None:
+                    self.instruments[name]['instrument'].dur = float(self.grn_conductor[name]['duration'][i])
+                    self.instruments[name]['instrument'].dens = float(self.grn_conductor[name]['density'][i])
+                # The sends to the shared buses are not audio signals, they are set at each update
+                if self.timeline is None or self.instruments[name].get('bus') is not None:
+                    self.set_reverb(name, float(self.grn_conductor[name]['reverb_wet'][i]))
@@ -159,6 +159,54 @@ def random_walk(current_key):
     :return chords: Random neighbour within the circle
     """
     return random.choice(circle_of_fifths[current_key])
+
+
+def build_chord_masks(key_chords):
+    """
+    Chord masks building function
+
+    :param key_chords: List of the playable chords of each key
+    :return masks: Boolean array of size nb_keys*nb_chords*128, True for the midi notes belonging to each chord
+    """
+    masks = np.zeros((len(key_chords), max(len(chords) for chords in key_chords), 128), dtype=bool)
+    pitch_classes = np.arange(128) % 12
+    for k, chords in enumerate(key_chords):
+        for c, chord in enumerate(chords):
+            masks[k, c] = np.isin(pitch_classes, [onset_dict[note] % 12 for note in chord])
+    return masks
+
+
+# Lookup tables built once for the 24 keys of the circle of fifths, keys are referred to by their index in KEYS
+KEYS = list(circle_of_fifths.keys())
+KEY_CHORDS = [build_chords(build_key(key)) for key in KEYS]
+KEY_NEIGHBOURS = np.array([[KEYS.index(tuple(neighbour)) for neighbour in circle_of_fifths[key]] for key in KEYS], dtype=np.int8)
+CHORD_MASKS = build_chord_masks(KEY_CHORDS)
+MIDI_NOTES = np.arange(128)
+
+
+def quantized_pitches(key, chord, inf, sup):
+    """
+    Table based pitch quantizing function, equivalent to pitch_quantizer up to the order of the pitches
+
+    :param key: Index of the key in KEYS
+    :param chord: Index of the chord in KEY_CHORDS[key]
+    :param inf: Lowest midi note
+    :param sup: Highest midi note (excluded)
+    :return: Array of the midi notes of the chord in [inf, sup), in ascending order
+    """
+    inf, sup = max(inf, 0), min(sup, 128)
+    return MIDI_NOTES[inf:sup][CHORD_MASKS[key, chord, inf:sup]]
+
+
+def lowest_pitch(note, inf):
+    """
+    Lowest quantized pitch function
+
+    :param note: Note name
+    :param inf: Lowest midi note
+    :return: Lowest midi note of that pitch class above inf
+    """
+    return inf + (onset_dict[note]-inf) % 12
     
 
 def select_sample_by_key(samples_dir, chords):
@@ -220,3 +268,105 @@ def check_still_in_key(sample, chords):
         return list(sample.split('-')[-2]) in chords
     else:
         return False
+
+
+class Sample_Catalog:
+
+    def __init__(self, list_dirs):
+        """
+        Sample catalog initialization function
+
+        :param list_dirs: Directories in which to search for samples
+        :return: a catalog of the samples of each directory, indexed by key
+        """
+        self.index = {}
+        for samples_dir in list_dirs:
+            self.entry(samples_dir)
+
+
+    def scan(self, samples_dir):
+        """
+        Directory scanning function
+
+        :param samples_dir: Directory in which to search for samples
+        :return: Dictionary containing 1) the modification time of the directory; 2) all the samples;
+                                       3) the samples grouped by key
+        """
+        samples = []
+        by_key = {}
+        for file in sorted(os.listdir(samples_dir)):
+            if file.endswith('.wav'):
+                samples.append(file)
+                parts = file.split('-')
+                if len(parts) > 2:
+                    # Keys are stored like the chords they are compared to (list of characters)
+                    by_key.setdefault(tuple(parts[-2]), []).append(file)
+        return {'mtime':os.stat(samples_dir).st_mtime, 'samples':samples, 'by_key':by_key}
+
+
+    def entry(self, samples_dir):
+        """
+        Catalog entry function, the directory is scanned again only if it was modified
+
+        :param samples_dir: Directory in which to search for samples
+        :return: Catalog entry of the directory
+        """
+        samples_dir = str(samples_dir)
+        entry = self.index.get(samples_dir)
+        if entry is None or os.stat(samples_dir).st_mtime != entry['mtime']:
+            entry = self.scan(samples_dir)
+            self.index[samples_dir] = entry
+        return entry
+
+
+    def draw(self, groups, exclude, attempts=10):
+        """
+        Random drawing function
+
+        :param groups: Lists of samples to draw from
+        :param exclude: Samples that must not be drawn
+        :param attempts: Number of random draws before falling back to filtering the lists
+        :return sample: Random sample from the groups, or None if every sample is excluded
+        """
+        total = sum(len(group) for group in groups)
+        if total == 0:
+            return None
+        for attempt in range(attempts):
+            index = random.randrange(total)
+            for group in groups:
+                if index < len(group):
+                    break
+                index -= len(group)
+            if group[index] not in exclude:
+                return group[index]
+        samples = [sample for group in groups for sample in group if sample not in exclude]
+        if len(samples)>0:
+            return random.choice(samples)
+        else:
+            return None
+
+
+    def select_by_key(self, samples_dir, chords, exclude=()):
+        """
+        Sample selection by key
+
+        :param samples_dir: Directory in which to search for samples
+        :param chords: Chords allowed in the current key
+        :param exclude: Samples that must not be selected (e.g. recently used ones)
+        :return sample: Random choice from available samples, or None
+        """
+        by_key = self.entry(samples_dir)['by_key']
+        # Unique keys in the order of the chords, so that a seeded draw does not depend on string hashing
+        keys = dict.fromkeys(tuple(chord) for chord in chords)
+        return self.draw([by_key[key] for key in keys if key in by_key], exclude)
+
+
+    def select(self, samples_dir, exclude=()):
+        """
+        Sample selection (without key constraint)
+
+        :param samples_dir: Directory in which to search for samples
+        :param exclude: Samples that must not be selected (e.g. recently used ones)
+        :return sample: Randomly chosen sample, or None
+        """
+        return self.draw([self.entry(samples_dir)['samples']], exclude)